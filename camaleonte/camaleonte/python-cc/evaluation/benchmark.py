@@ -1,42 +1,328 @@
+"""
+End-to-end channel benchmark.
+
+Runs a sender and a receiver in separate processes for every client channel
+over a temporary LinuxFileSystem share (or the local Drive stand-in). It
+sweeps payload sizes, file counts and client counts, and appends one JSON
+object per run to the output file so results can be compared across commits.
+
+Usage (from the python-cc folder):
+    python3 -m evaluation.benchmark --protocols hash metadata --payload-sizes 256 4096
+    python3 -m evaluation.benchmark --mediums drive --latency 0.05
+    python3 -m evaluation.benchmark --segments 6 --parity 2 --tamper-rates 0 2 8 --file-counts 128
+
+Configurations whose batches do not fit the file slice of a channel are skipped.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing as mp
 import os
-import timeit
-
-ITERATIONS = 50
-TRIALS = 20
-
-def time_crc32(test_cnt: int, file_size: str) -> float:
-    res = timeit.timeit(
-        stmt=f"zlib.crc32(FILES[\"{file_size}\"])",
-        setup="import zlib; from __main__ import FILES",
-        number=test_cnt
-    )
-    return res
-
-def time_xxhash(test_cnt: int, file_size: str) -> float:
-    res = timeit.timeit(
-        stmt=f"xxhash.xxh3_64(FILES[\"{file_size}\"]).digest()",
-        setup="import xxhash; from __main__ import FILES",
-        number=test_cnt
-    )
-    return res
-
-# hash benchmark
-# FILE_SIZES = {
-#     "1 BYTE": 1,
-#     "1 KB": 1000,
-#     "1 MB": 1000000,
-#     "10 MB": 10000000,
-#     "100 MB": 100000000,
-#     "1 GB": 1000000000
-# }
-# FILES = {
-#     file_size : os.urandom(FILE_SIZES[file_size])
-#     for file_size in FILE_SIZES
-# }
-# print(f"Tests will be repeated: {ITERATIONS}\n")
-# for size in FILE_SIZES:
-#     print(f"TESTING {size} SIZED INPUT:")
-#     for i in range(TRIALS):
-#         res = time_crc32(ITERATIONS, size)
-#         print(f"Test {i}: {res} seconds")
-#     print()
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from helpers import disrupter
+from src.metrics import metrics, JsonSink
+from src.mediums.linux_filesystem import LinuxFileSystem
+from src.protocol.hash_protocol import HashProtocol
+from src.protocol.metadata_protocol import MetadataProtocol
+from src.utils import encode_base64, set_hash_byte
+
+
+PROTOCOLS = {"hash": HashProtocol, "metadata": MetadataProtocol}
+WORDLIST = os.path.join(os.path.dirname(__file__), os.pardir, "helpers", "wordlist.txt")
+
+
+def carrier_text(words: list[str], size: int) -> bytes:
+    out = []
+    length = 0
+    while length < size:
+        word = random.choice(words)
+        out.append(word)
+        length += len(word) + 1
+    return " ".join(out).encode()
+
+
+### MEDIUM SETUP
+# returns (medium args passed to each process, cleanup function, request counter)
+def setup_linux(file_count: int, file_size: int, client_count: int, args):
+    words = open(WORDLIST).read().split()
+    root = tempfile.mkdtemp(prefix="camaleonte-bench-")
+    # the first file is the config file holding the client count
+    for i in range(file_count + 1):
+        data = carrier_text(words, file_size)
+        if i == 0:
+            data = set_hash_byte(data, client_count)
+        with open(os.path.join(root, f"{i:05d}.txt"), "wb") as fil:
+            fil.write(data)
+    return ("linux", root, args.packed_xattrs), lambda: shutil.rmtree(root, ignore_errors=True), lambda: None
+
+
+def setup_drive(file_count: int, file_size: int, client_count: int, args):
+    from helpers.drive_standin import DriveStandin, FOLDER_ID
+    words = open(WORDLIST).read().split()
+    standin = DriveStandin(latency=args.latency, error_rate=args.error_rate,
+                           rate_limit=args.rate_limit)
+    for i in range(file_count + 1):
+        data = carrier_text(words, file_size)
+        if i == 0:
+            data = set_hash_byte(data, client_count)
+        standin.add_file(f"{i:05d}.txt", data)
+    standin.start()
+    return ("drive", standin.url, FOLDER_ID, not args.no_watch_changes), standin.stop, lambda: standin.stats["api_calls"]
+
+
+def open_medium(medium: tuple):
+    if medium[0] == "linux":
+        return LinuxFileSystem(medium[1], packed_xattrs=medium[2])
+    from src.mediums.drive_filesystem import GoogleDriveFilesystem
+    return GoogleDriveFilesystem(None, medium[2], standin_url=medium[1], watch_changes=medium[3])
+
+
+### TAMPERING
+# config and sync files are left alone, tampering with those breaks the
+# channel instead of damaging a batch
+def protected_files(file_count: int, client_count: int) -> set[str]:
+    max_clients = 1 << max(client_count - 1, 0).bit_length()
+    files_per_client = file_count // max_clients
+    return {f"{i:05d}.txt" for i in [0] + [1 + c * files_per_client for c in range(client_count)]}
+
+
+# runs the disrupter on random carriers, `rate` times per second on average
+def tamperer(medium: tuple, rate: float, protected: set[str]) -> None:
+    sys.stdout = open(os.devnull, "w")
+    if medium[0] == "linux":
+        carriers = sorted(set(os.listdir(medium[1])) - protected)
+    else:
+        from src.mediums.google_api import GoogleDriveAPI
+        api = GoogleDriveAPI()
+        api.connect_standin(medium[1])
+    while True:
+        time.sleep(random.expovariate(rate))
+        if medium[0] == "linux":
+            disrupter.tamper_with_file(os.path.join(medium[1], random.choice(carriers)))
+        else:
+            disrupter.tamper_with_metadata(api, medium[2], protected)
+
+
+### PEERS
+def peer(role: str, medium: tuple, protocol: str, options: dict, channel: int,
+         payload: bytes, barrier, results, tune: bool = False, metrics_path: str = None) -> None:
+    # keep any output out of the measurement
+    sys.stdout = open(os.devnull, "w")
+    if metrics_path:
+        metrics.set_sink(JsonSink(metrics_path))
+    fs = open_medium(medium)
+    if tune:
+        fs.tune_properties()
+    fs.set_channel_pos(channel)
+    fs.update_virtual_filesystem()
+    cc = PROTOCOLS[protocol](fs, **options)
+    barrier.wait()
+    metrics.reset()
+    start = time.perf_counter()
+    if role == "sender":
+        cc.write(payload)
+        results.put((role, channel, time.perf_counter() - start, True, metrics.snapshot()))
+    else:
+        data = cc.read()
+        results.put((role, channel, time.perf_counter() - start, data == payload, metrics.snapshot()))
+    metrics.flush()
+
+
+# the reason the options do not fit the file slice of a channel, None if they do
+def unfit_reason(medium: tuple, protocol: str, options: dict, tune: bool) -> str | None:
+    fs = open_medium(medium)
+    if tune:
+        fs.tune_properties()
+    fs.set_channel_pos(0)
+    fs.update_virtual_filesystem()
+    try:
+        PROTOCOLS[protocol](fs, **options).check_layout()
+    except ValueError as e:
+        return str(e)
+    return None
+
+
+def run_once(medium: tuple, protocol: str, options: dict, payload_size: int,
+             client_count: int, timeout: float, payload_kind: str = "random",
+             tune: bool = False, metrics_path: str = None, tamper_rate: float = 0.0,
+             protected: set[str] = ()) -> dict:
+    if payload_kind == "text":
+        payload = carrier_text(open(WORDLIST).read().split(), payload_size)[:payload_size]
+    elif payload_kind == "repeat":
+        payload = (b"A" * 64 + b"B" * 64) * (payload_size // 128 + 1)
+        payload = payload[:payload_size]
+    else:
+        payload = os.urandom(payload_size)
+    # base64 keeps the terminator out of unframed payloads
+    if payload_kind == "random" and not options.get("framing"):
+        payload = encode_base64(payload)[:payload_size]
+    barrier = mp.Barrier(2 * client_count)
+    results = mp.Queue()
+    procs = [
+        mp.Process(target=peer, args=(role, medium, protocol, options, channel,
+                                      payload, barrier, results, tune, metrics_path))
+        for channel in range(client_count)
+        for role in ("receiver", "sender")
+    ]
+    if tamper_rate:
+        procs.append(mp.Process(target=tamperer, args=(medium, tamper_rate, protected)))
+    for proc in procs:
+        proc.start()
+    outcome = {"elapsed_s": 0.0, "ok": True, "batches": 0, "nacks": 0,
+               "round_trips": 0, "round_trip_seconds": 0.0, "raw_bytes": 0, "wire_bytes": 0,
+               "writes": 0, "writes_skipped": 0, "segments_resent": 0, "segments_repaired": 0}
+    try:
+        for _ in range(2 * client_count):
+            role, channel, elapsed, ok, result = results.get(timeout=timeout)
+            if role == "receiver":
+                outcome["elapsed_s"] = max(outcome["elapsed_s"], elapsed)
+                outcome["ok"] &= ok
+                outcome["segments_repaired"] += result["counters"].get("segments_repaired", 0)
+            else:
+                for key in ("batches", "nacks", "round_trips", "raw_bytes", "wire_bytes",
+                            "writes", "writes_skipped", "segments_resent"):
+                    outcome[key] += result["counters"].get(key, 0)
+                rtt = result["histograms"].get("batch_rtt")
+                outcome["round_trip_seconds"] += rtt["sum_s"] if rtt else 0.0
+    except Exception:
+        outcome["ok"] = False
+        outcome["error"] = "timeout"
+    finally:
+        for proc in procs:
+            proc.kill()
+            proc.join()
+    # goodput counts payload bytes delivered across all channels
+    elapsed = outcome["elapsed_s"] or float("nan")
+    outcome["goodput_Bps"] = payload_size * client_count / elapsed if outcome["ok"] else 0.0
+    outcome["batch_rtt_s"] = outcome.pop("round_trip_seconds") / max(outcome["round_trips"], 1)
+    outcome["retransmit_rate"] = outcome["nacks"] / max(outcome["batches"], 1)
+    outcome["wire_ratio"] = outcome["wire_bytes"] / max(outcome["raw_bytes"], 1)
+    return outcome
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end covert channel benchmark")
+    parser.add_argument("--mediums", nargs="+", default=["linux"], choices=["linux", "drive"])
+    parser.add_argument("--protocols", nargs="+", default=["hash", "metadata"], choices=list(PROTOCOLS))
+    parser.add_argument("--payload-sizes", nargs="+", type=int, default=[256, 4096])
+    parser.add_argument("--file-counts", nargs="+", type=int, default=[64])
+    parser.add_argument("--client-counts", nargs="+", type=int, default=[1])
+    parser.add_argument("--windows", nargs="+", type=int, default=[1])
+    parser.add_argument("--workers", nargs="+", type=int, default=[1], help="parallel file workers")
+    parser.add_argument("--bytes-per-file", type=int, default=1, help="hash protocol carrier width (1-4)")
+    parser.add_argument("--packed-xattrs", action="store_true", help="linux: pack properties into few xattrs")
+    parser.add_argument("--tune", action="store_true",
+                        help="metadata: probe the property layout of the share before the run")
+    parser.add_argument("--framing", action="store_true", help="use length prefixed binary batches")
+    parser.add_argument("--compression", action="store_true", help="compress messages (implies --framing)")
+    parser.add_argument("--segments", type=int, default=1,
+                        help="tagged segments per batch, only damaged ones are resent (implies --framing)")
+    parser.add_argument("--parity", type=int, default=0,
+                        help="of those segments, how many carry parity so the reader repairs damage itself")
+    parser.add_argument("--tamper-rates", nargs="+", type=float, default=[0.0],
+                        help="disrupter.py tampers per second during each run")
+    parser.add_argument("--payload-kind", default="random", choices=["random", "text", "repeat"],
+                        help="random bytes, compressible carrier text or a repeating pattern")
+    parser.add_argument("--no-delta-writes", action="store_true",
+                        help="rewrite every carrier even when it already holds its chunk")
+    parser.add_argument("--file-size", type=int, default=2048, help="carrier file size in bytes")
+    parser.add_argument("--trials", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--latency", type=float, default=0.0, help="drive stand-in latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="drive stand-in 5xx rate")
+    parser.add_argument("--rate-limit", type=float, default=None, help="drive stand-in calls/s")
+    parser.add_argument("--no-watch-changes", action="store_true",
+                        help="drive: poll the sync file instead of the changes feed")
+    parser.add_argument("--output", default="benchmark_results.jsonl")
+    parser.add_argument("--metrics", default=None, help="append per peer metrics events to this file")
+    args = parser.parse_args()
+
+    revision = git_revision()
+    sweep = itertools.product(args.mediums, args.protocols, args.windows, args.workers,
+                              args.file_counts, args.client_counts, args.payload_sizes, args.tamper_rates)
+    with open(args.output, "a") as out:
+        for medium_name, protocol, window, workers, file_count, client_count, payload_size, tamper_rate in sweep:
+            for trial in range(args.trials):
+                if medium_name == "linux":
+                    medium, cleanup, api_calls = setup_linux(file_count, args.file_size, client_count, args)
+                else:
+                    medium, cleanup, api_calls = setup_drive(file_count, args.file_size, client_count, args)
+                layout = None
+                try:
+                    tune = args.tune and protocol == "metadata"
+                    if tune:
+                        # probe once up front, the peers then read the stored layout
+                        layout = open_medium(medium).tune_properties()
+                    options = {"window": window,
+                               "framing": args.framing or args.compression or args.segments > 1,
+                               "compression": args.compression, "workers": workers,
+                               "delta_writes": not args.no_delta_writes, "segments": args.segments,
+                               "parity": args.parity}
+                    if protocol == "hash":
+                        options["bytes_per_file"] = args.bytes_per_file
+                    skipped = unfit_reason(medium, protocol, options, tune)
+                    if not skipped:
+                        calls = api_calls()
+                        outcome = run_once(medium, protocol, options, payload_size,
+                                           client_count, args.timeout, args.payload_kind, tune,
+                                           args.metrics, tamper_rate, protected_files(file_count, client_count))
+                        # drive api calls made during the run (setup excluded), None on linux
+                        outcome["api_calls"] = None if calls is None else api_calls() - calls
+                finally:
+                    cleanup()
+                if skipped:
+                    # no trial of this configuration can run, nothing is recorded
+                    print(f"{medium_name:6} {protocol:8} w={window} workers={workers} files={file_count} "
+                          f"clients={client_count} payload={payload_size}: skipped, {skipped}")
+                    break
+                record = {
+                    "revision": revision,
+                    "timestamp": time.time(),
+                    "medium": medium_name,
+                    "protocol": protocol,
+                    "window": window,
+                    "workers": workers,
+                    "bytes_per_file": args.bytes_per_file if protocol == "hash" else None,
+                    "packed_xattrs": args.packed_xattrs if medium_name == "linux" else None,
+                    "property_layout": layout,
+                    "framing": options["framing"],
+                    "compression": args.compression,
+                    "segments": args.segments,
+                    "parity": args.parity,
+                    "tamper_rate": tamper_rate,
+                    "delta_writes": not args.no_delta_writes,
+                    "payload_kind": args.payload_kind,
+                    "file_count": file_count,
+                    "client_count": client_count,
+                    "payload_size": payload_size,
+                    "trial": trial,
+                    **outcome,
+                }
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+                calls = "" if record["api_calls"] is None else f", {record['api_calls']} calls"
+                print(f"{medium_name:6} {protocol:8} w={window} workers={workers} files={file_count} "
+                      f"clients={client_count} payload={payload_size}: "
+                      f"{record['goodput_Bps']:.1f} B/s, rtt {record['batch_rtt_s']*1000:.1f} ms, "
+                      f"nack {record['retransmit_rate']:.2%}, wire {record['wire_ratio']:.2f}x, "
+                      f"tamper {tamper_rate}/s, repaired {record['segments_repaired']}{calls}"
+                      f"{'' if record['ok'] else ' FAILED'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
+import os
 import time
 import random
 import string
-from src.mediums.google_api import GoogleDriveAPI
 
 # --- Configuration ---
 CREDENTIALS_FILE = "creds/credentials.json"
@@ -9,22 +9,24 @@ FOLDER_ID = "1hx8LGnjALicYlCFU5mowAUI7L7gb-Chm"
 TAMPER_INTERVAL = 2  # Time in seconds between each tampering attempt
 PROPERTY_LIMIT = 30 # Google Drive's appProperties limit per app
 
-def tamper_with_metadata(gdrive_api):
+def tamper_with_metadata(gdrive_api, folder_id=FOLDER_ID, protected=None):
     """
     Randomly modifies the metadata of a file in the specified folder
     to simulate interference. It will either add, modify, or delete a property.
+    Files named in `protected` are left alone (by default the first file).
     """
     print("--- TAMPERING ---")
     
     try:
         # Get all files, find the sync file to exclude it
-        all_files = gdrive_api.list_files(directory_id=FOLDER_ID)
+        all_files = gdrive_api.list_files(directory_id=folder_id)
         if not all_files:
             print("No files found in the specified folder.")
             return
 
-        sync_file = sorted(all_files, key=lambda f: f['name'])[0]
-        data_files = [f for f in all_files if f['id'] != sync_file['id']]
+        if protected is None:
+            protected = {sorted(all_files, key=lambda f: f['name'])[0]['name']}
+        data_files = [f for f in all_files if f['name'] not in protected]
 
         if not data_files:
             print("No data files to tamper with.")
@@ -42,31 +44,7 @@ def tamper_with_metadata(gdrive_api):
         if properties is None:
             properties = {}
 
-        # Decide on an action: 0=add, 1=modify, 2=delete
-        # We prioritize adding if the file has few properties, and modifying/deleting if it has many.
-        if len(properties) == 0:
-            action = 0 # Must add
-        elif len(properties) >= PROPERTY_LIMIT:
-            action = random.choice([1, 2]) # Can't add, so modify or delete
-        else:
-            action = random.choice([0, 1, 2])
-        
-        if action == 1 and properties: # Modify
-            key_to_modify = random.choice(list(properties.keys()))
-            new_value = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
-            properties[key_to_modify] = new_value
-            print(f"Action: MODIFIED property '{key_to_modify}' to '{new_value}'")
-        
-        elif action == 2 and properties: # Delete
-            key_to_delete = random.choice(list(properties.keys()))
-            properties[key_to_delete] = None  # Setting a property to None deletes it
-            print(f"Action: DELETED property '{key_to_delete}'")
-            
-        else: # Add (or default if modify/delete fails)
-            random_key = f"tamper_{''.join(random.choices(string.ascii_lowercase, k=4))}"
-            random_value = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
-            properties[random_key] = random_value
-            print(f"Action: ADDED property '{random_key}': '{random_value}'")
+        tamper_properties(properties)
 
         # Apply the changes
         gdrive_api.update_properties(file_id, properties)
@@ -77,7 +55,65 @@ def tamper_with_metadata(gdrive_api):
     
     print("--- TAMPERING COMPLETE ---\n")
 
+def tamper_properties(properties):
+    """
+    Adds, modifies or deletes one random entry of a property dict in place.
+    Deleted properties are set to None.
+    """
+    # Decide on an action: 0=add, 1=modify, 2=delete
+    # We prioritize adding if the file has few properties, and modifying/deleting if it has many.
+    if len(properties) == 0:
+        action = 0 # Must add
+    elif len(properties) >= PROPERTY_LIMIT:
+        action = random.choice([1, 2]) # Can't add, so modify or delete
+    else:
+        action = random.choice([0, 1, 2])
+
+    if action == 1 and properties: # Modify
+        key_to_modify = random.choice(list(properties.keys()))
+        new_value = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
+        properties[key_to_modify] = new_value
+        print(f"Action: MODIFIED property '{key_to_modify}' to '{new_value}'")
+
+    elif action == 2 and properties: # Delete
+        key_to_delete = random.choice(list(properties.keys()))
+        properties[key_to_delete] = None  # Setting a property to None deletes it
+        print(f"Action: DELETED property '{key_to_delete}'")
+
+    else: # Add (or default if modify/delete fails)
+        random_key = f"tamper_{''.join(random.choices(string.ascii_lowercase, k=4))}"
+        random_value = ''.join(random.choices(string.ascii_letters + string.digits, k=10))
+        properties[random_key] = random_value
+        print(f"Action: ADDED property '{random_key}': '{random_value}'")
+
+def tamper_with_file(path):
+    """
+    The same interference on a local share (see LinuxFileSystem): tampers
+    with the user.* xattrs of the file, or appends a character to its content
+    which changes the hash the hash protocol reads.
+    """
+    print(f"Tampering with file: {path}")
+    try:
+        if random.random() < 0.5:
+            with open(path, 'ab') as fil:
+                fil.write(random.choice(string.ascii_letters).encode())
+            print("Action: APPENDED to content")
+            return
+        properties = {
+            attr.split("user.", 1)[1]: os.getxattr(path, attr)
+            for attr in os.listxattr(path) if attr.startswith("user.")
+        }
+        tamper_properties(properties)
+        for key, value in properties.items():
+            if value is None:
+                os.removexattr(path, f"user.{key}")
+            elif isinstance(value, str):
+                os.setxattr(path, f"user.{key}", value.encode())
+    except Exception as e:
+        print(f"An error occurred during tampering: {e}")
+
 if __name__ == "__main__":
+    from src.mediums.google_api import GoogleDriveAPI
     print("Initializing filesystem for automated tampering...")
     try:
         # Use the GoogleDriveAPI directly to manipulate properties
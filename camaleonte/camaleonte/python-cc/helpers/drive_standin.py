@@ -0,0 +1,347 @@
+"""
+Local stand-in for the subset of the Google Drive v3 REST API used by
+src/mediums/google_api.py, so the Drive medium can be benchmarked and tested
+without a Google account or network access.
+
+Supported: files.list, files.get (metadata and alt=media), files.update
+(appProperties/trashed/name and simple or multipart media uploads),
+files.delete, changes.getStartPageToken, changes.list and multipart/mixed
+batch requests. The `fields` parameter is
+ignored, full resources are always returned.
+
+Latency, rate limits and 5xx errors can be injected to see how the channel
+behaves under a degraded Drive.
+
+Usage:
+    python3 -m helpers.drive_standin --files 64 --latency 0.05
+    GoogleDriveFilesystem(None, FOLDER_ID, standin_url="http://127.0.0.1:8765/")
+"""
+
+import argparse
+import email.parser
+import email.policy
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+FOLDER_ID = "standin-folder"
+# drive limits each appProperties key+value to 124 bytes
+MAX_PROPERTY_BYTES = 124
+MAX_PROPERTY_COUNT = 30
+
+
+class DriveStandin:
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 latency: float = 0.0,
+                 error_rate: float = 0.0,
+                 rate_limit: float = None,
+                 seed: int = None) -> None:
+        """
+        Args:
+            host/port: Address to bind, port 0 picks a free port.
+            latency: Seconds added to every HTTP request (a batch counts once).
+            error_rate: Probability of answering any (sub)request with a 503.
+            rate_limit: Max (sub)requests per second before answering 429.
+            seed: Seed for the error injection.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.files = {}
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        # every write appends a change, page tokens are offsets into this log
+        self.changes = []
+        self.stats = {"http_requests": 0, "api_calls": 0, "errors": 0, "rate_limited": 0}
+        self.window_start = time.monotonic()
+        self.window_calls = 0
+        self.server = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> str:
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    ### FILE STORE
+    def add_file(self, name: str, content: bytes = b"", parent: str = FOLDER_ID) -> str:
+        with self.lock:
+            file_id = f"{parent}-{next(self.ids):06d}"
+            self.files[file_id] = {
+                "id": file_id,
+                "name": name,
+                "mimeType": "text/plain",
+                "parents": [parent],
+                "trashed": False,
+                "appProperties": {},
+                "content": content,
+            }
+            self._touch(self.files[file_id])
+        return file_id
+
+    def _touch(self, f: dict) -> None:
+        f["version"] = str(int(f.get("version", "0")) + 1)
+        f["modifiedTime"] = datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+        f["md5Checksum"] = hashlib.md5(f["content"]).hexdigest()
+        f["size"] = str(len(f["content"]))
+        self._log_change(f["id"], removed=False, time=f["modifiedTime"])
+
+    def _log_change(self, file_id: str, removed: bool, time: str) -> None:
+        self.changes.append({"kind": "drive#change", "changeType": "file",
+                             "fileId": file_id, "removed": removed, "time": time})
+
+    @staticmethod
+    def _resource(f: dict) -> dict:
+        return {k: v for k, v in f.items() if k != "content"}
+
+    ### FAULT INJECTION
+    # returns an error response for this call, or None to serve it
+    def _inject_fault(self):
+        with self.lock:
+            self.stats["api_calls"] += 1
+            if self.rate_limit:
+                now = time.monotonic()
+                if now - self.window_start >= 1:
+                    self.window_start = now
+                    self.window_calls = 0
+                self.window_calls += 1
+                if self.window_calls > self.rate_limit:
+                    self.stats["rate_limited"] += 1
+                    return _error(429, "rateLimitExceeded", "Rate limit exceeded")
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return _error(503, "backendError", "Injected backend error")
+        return None
+
+    ### API DISPATCH
+    # serves one api call, returns (status, headers, body)
+    def dispatch(self, method: str, target: str, headers, body: bytes):
+        fault = self._inject_fault()
+        if fault:
+            return fault
+        parsed = urllib.parse.urlparse(target)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        path = parsed.path
+        match = re.fullmatch(r"/drive/v3/changes(/startPageToken)?", path)
+        if match:
+            if method != "GET":
+                return _error(405, "methodNotAllowed", f"{method} not supported")
+            return self._changes(query, bool(match.group(1)))
+        match = re.fullmatch(r"/(upload/)?drive/v3/files(?:/([^/]+))?", path)
+        if not match:
+            return _error(404, "notFound", f"Unknown path {path}")
+        upload, file_id = match.groups()
+        if file_id is None:
+            if method == "GET":
+                return self._list(query)
+            return _error(501, "notImplemented", "Only files.list is supported on the collection")
+        with self.lock:
+            f = self.files.get(file_id)
+            if f is None:
+                return _error(404, "notFound", f"File not found: {file_id}")
+            if method == "GET":
+                if query.get("alt") == "media":
+                    return 200, {"Content-Type": "application/octet-stream"}, f["content"]
+                return _json(200, self._resource(f))
+            if method == "DELETE":
+                del self.files[file_id]
+                self._log_change(file_id, removed=True, time=f["modifiedTime"])
+                return 204, {}, b""
+            if method == "PATCH":
+                return self._update(f, upload, query, headers, body)
+        return _error(405, "methodNotAllowed", f"{method} not supported")
+
+    def _list(self, query: dict):
+        q = query.get("q", "")
+        parent = re.search(r"'([^']+)' in parents", q)
+        name = re.search(r"name = '([^']+)'", q)
+        with self.lock:
+            files = [
+                self._resource(f) for f in self.files.values()
+                if (not parent or parent.group(1) in f["parents"])
+                and (not name or f["name"] == name.group(1))
+                and not ("trashed=false" in q.replace(" ", "") and f["trashed"])
+            ]
+        files.sort(key=lambda f: f["name"])
+        start = int(query.get("pageToken", 0))
+        size = int(query.get("pageSize", 100))
+        resp = {"files": files[start:start + size]}
+        if start + size < len(files):
+            resp["nextPageToken"] = str(start + size)
+        return _json(200, resp)
+
+    def _changes(self, query: dict, start_token: bool):
+        with self.lock:
+            if start_token:
+                return _json(200, {"kind": "drive#startPageToken", "startPageToken": str(len(self.changes))})
+            start = int(query.get("pageToken", 0))
+            size = int(query.get("pageSize", 100))
+            resp = {"kind": "drive#changeList", "changes": self.changes[start:start + size]}
+            if start + size < len(self.changes):
+                resp["nextPageToken"] = str(start + size)
+            else:
+                resp["newStartPageToken"] = str(len(self.changes))
+        return _json(200, resp)
+
+    def _update(self, f: dict, upload: str, query: dict, headers, body: bytes):
+        metadata = {}
+        if upload:
+            upload_type = query.get("uploadType")
+            if upload_type == "media":
+                f["content"] = body
+            elif upload_type == "multipart":
+                metadata, f["content"] = _split_related(headers.get("Content-Type"), body)
+            else:
+                return _error(400, "badRequest", f"uploadType {upload_type} not supported by the stand-in")
+        elif body:
+            metadata = json.loads(body)
+        if "appProperties" in metadata:
+            props = dict(f["appProperties"])
+            for key, val in metadata["appProperties"].items():
+                if val is None:
+                    props.pop(key, None)
+                elif len(key.encode()) + len(str(val).encode()) > MAX_PROPERTY_BYTES:
+                    return _error(400, "badRequest", f"Property {key} exceeds {MAX_PROPERTY_BYTES} bytes")
+                else:
+                    props[key] = str(val)
+            if len(props) > MAX_PROPERTY_COUNT:
+                return _error(403, "propertyCountLimitExceeded", "Too many appProperties")
+            f["appProperties"] = props
+        for key in ("name", "trashed"):
+            if key in metadata:
+                f[key] = metadata[key]
+        self._touch(f)
+        return _json(200, self._resource(f))
+
+    # answers a multipart/mixed batch by dispatching every embedded request
+    def batch(self, content_type: str, body: bytes):
+        message = _parse_mime(content_type, body)
+        parts = []
+        for part in message.iter_parts():
+            raw = part.get_payload(decode=True)
+            head, _, sub_body = raw.partition(b"\n\n") if b"\r\n\r\n" not in raw else raw.partition(b"\r\n\r\n")
+            lines = head.decode().splitlines()
+            method, target, _ = lines[0].split(" ", 2)
+            sub_headers = dict(line.split(": ", 1) for line in lines[1:] if ": " in line)
+            status, headers, content = self.dispatch(method, target, sub_headers, sub_body)
+            content_id = part.get("Content-ID", "<>")[1:-1]
+            head = [f"HTTP/1.1 {status} {_REASONS.get(status, 'OK')}"]
+            head += [f"{k}: {v}" for k, v in headers.items()]
+            parts.append(
+                "Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                + "\r\n".join(head) + "\r\n\r\n" + content.decode("utf-8", "replace")
+            )
+        boundary = f"batch_standin_{next(self.ids)}"
+        payload = "".join(f"--{boundary}\r\n{p}\r\n" for p in parts) + f"--{boundary}--\r\n"
+        return 200, {"Content-Type": f"multipart/mixed; boundary={boundary}"}, payload.encode()
+
+
+_REASONS = {200: "OK", 204: "No Content", 400: "Bad Request", 403: "Forbidden",
+            404: "Not Found", 405: "Method Not Allowed", 429: "Too Many Requests",
+            501: "Not Implemented", 503: "Service Unavailable"}
+
+
+def _json(status: int, obj: dict):
+    return status, {"Content-Type": "application/json; charset=UTF-8"}, json.dumps(obj).encode()
+
+
+def _error(status: int, reason: str, message: str):
+    return _json(status, {"error": {
+        "code": status, "message": message,
+        "errors": [{"domain": "global", "reason": reason, "message": message}],
+    }})
+
+
+def _parse_mime(content_type: str, body: bytes):
+    raw = f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    return email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(raw)
+
+
+# multipart/related media upload: json metadata part followed by the content
+def _split_related(content_type: str, body: bytes) -> tuple[dict, bytes]:
+    parts = list(_parse_mime(content_type, body).iter_parts())
+    metadata = json.loads(parts[0].get_payload(decode=True) or b"{}")
+    return metadata, parts[1].get_payload(decode=True)
+
+
+def _make_handler(standin: DriveStandin):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body go out as separate small writes, with nagle on the
+        # body waits for the client's delayed ack (~40 ms per small response)
+        disable_nagle_algorithm = True
+
+        def _serve(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length) if length else b""
+            with standin.lock:
+                standin.stats["http_requests"] += 1
+            if standin.latency:
+                time.sleep(standin.latency)
+            if self.path.startswith("/batch/drive/v3"):
+                status, headers, content = standin.batch(self.headers.get("Content-Type"), body)
+            else:
+                status, headers, content = standin.dispatch(self.command, self.path, self.headers, body)
+            self.send_response(status)
+            for key, val in headers.items():
+                self.send_header(key, val)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _serve
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Google Drive v3 stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--files", type=int, default=64, help="carrier files to create")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=None)
+    args = parser.parse_args()
+
+    standin = DriveStandin(args.host, args.port, args.latency, args.error_rate, args.rate_limit)
+    for i in range(args.files):
+        standin.add_file(f"file{i:04d}.txt", f"carrier file {i}\n".encode())
+    print(f"Drive stand-in serving {args.files} files in folder '{FOLDER_ID}' at {standin.url}")
+    print("Press Ctrl+C to stop.")
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStand-in stopped by user.")
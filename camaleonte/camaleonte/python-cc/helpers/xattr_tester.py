@@ -41,5 +41,28 @@ def test_xattr_capacity(file_path="xattr_testfile.txt", value_size=128, max_keys
     else:
         print("No failure detected (may not have reached system limit)")
 
+# largest single value, LinuxFileSystem.probe_packed_size() measures the same for packed xattrs
+def test_xattr_value_size(file_path="xattr_testfile.txt", key="user.hash", max_size=1 << 16):
+    print("Starting single xattr size test on:", file_path)
+
+    with open(file_path, "w") as f:
+        f.write("test\n")
+
+    low, high = 0, max_size
+    try:
+        while low < high:
+            size = (low + high + 1) // 2
+            try:
+                os.setxattr(file_path, key, b'x' * size)
+                low = size
+            except OSError:
+                high = size - 1
+    finally:
+        os.remove(file_path)
+
+    print(f"Largest single xattr value: {low} bytes")
+    return low
+
 if __name__ == "__main__":
     test_xattr_capacity()
+    test_xattr_value_size()
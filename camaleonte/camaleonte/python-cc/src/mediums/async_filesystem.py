@@ -0,0 +1,119 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from src.mediums.filesystem import Filesystem, Signal, PollWait
+from src.metrics import metrics
+
+
+# threads running medium calls for every async channel of a poller
+POLLER_WORKERS = 32
+
+
+# one polling task answering the signal waits of every async channel in the
+# process. each round reads the sync file of every waiting channel at once,
+# then sleeps for the shortest period their poll schedules ask for (the per
+# medium request budgets still cap the polls, see PollSchedule). the mediums
+# do blocking I/O (nfs syscalls, drive http requests), so their calls run on
+# the thread pool of the poller instead of the event loop
+class SignalPoller:
+    def __init__(self, workers: int = POLLER_WORKERS) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # future -> (filesystem, signals, backoff of the wait)
+        self.waiters = {}
+        self.task = None
+        self.wakeup = None
+
+    # runs a blocking medium call on the thread pool
+    async def run(self, call, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(call, *args))
+
+    async def wait_for_signal(self, filesystem: Filesystem, *signals: Signal) -> tuple[Signal, int]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.waiters[future] = (filesystem, signals, filesystem.poll_schedule.wait())
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = loop.create_task(self.poll())
+        else:
+            # a new wait is polled right away, not after the current backoff
+            self.wakeup.set()
+        try:
+            return await future
+        finally:
+            self.waiters.pop(future, None)
+
+    async def poll(self) -> None:
+        polled = set()
+        while self.waiters:
+            self.wakeup.clear()
+            waiters = list(self.waiters.items())
+            results = await asyncio.gather(*(
+                self.run(self.poll_channel, filesystem, wait if future in polled else None)
+                for future, (filesystem, _, wait) in waiters
+            ), return_exceptions=True)
+            metrics.count('poller_rounds')
+            for (future, (_, signals, _)), result in zip(waiters, results):
+                polled.add(future)
+                if future.done():
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                elif result[0] in signals:
+                    future.set_result(result)
+            periods = [wait.next_period() for future, (_, _, wait) in self.waiters.items() if not future.done()]
+            if not periods:
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), min(periods))
+            except asyncio.TimeoutError:
+                pass
+            polled &= set(self.waiters)
+
+    # one poll of a channel, charged to its medium budget after the first
+    def poll_channel(self, filesystem: Filesystem, wait: PollWait = None) -> tuple[Signal, int]:
+        if wait:
+            wait.acquire()
+        return filesystem.poll_signal()
+
+
+# asyncio front of a Filesystem (one channel), every call runs on the thread
+# pool of the poller and signal waits are answered by its polling task
+class AsyncFilesystem:
+    def __init__(self, filesystem: Filesystem, poller: SignalPoller = None) -> None:
+        self.filesystem = filesystem
+        self.poller = poller or SignalPoller()
+
+    async def run(self, call, *args):
+        return await self.poller.run(call, *args)
+
+    async def read_content(self, file: str) -> bytes:
+        return await self.run(self.filesystem.read_content, file)
+
+    async def write_content(self, file: str, data: bytes) -> None:
+        await self.run(self.filesystem.write_content, file, data)
+
+    async def read_signal(self) -> Signal:
+        return (await self.read_signal_arg())[0]
+
+    async def read_signal_arg(self) -> tuple[Signal, int]:
+        return await self.run(self.filesystem.read_signal_arg)
+
+    async def set_signal(self, sig: Signal, arg: int = None) -> None:
+        await self.run(self.filesystem.set_signal, sig, arg)
+
+    async def wait_for_signal(self, *signals: Signal) -> tuple[Signal, int]:
+        return await self.poller.wait_for_signal(self.filesystem, *signals)
+
+    async def get_files(self) -> list[str]:
+        return await self.run(self.filesystem.get_files)
+
+    async def get_client_count(self) -> int:
+        return await self.run(self.filesystem.get_client_count)
+
+    async def set_client_count(self, cnt: int) -> None:
+        await self.run(self.filesystem.set_client_count, cnt)
+
+    async def update_virtual_filesystem(self) -> bool:
+        return await self.run(self.filesystem.update_virtual_filesystem)
@@ -1,30 +1,63 @@
 # src/mediums/drive_filesystem.py
 
+import threading
 from typing import List, Dict
 
 from .filesystem import MetadataEncoding, HashEncoding, Signal
 from .google_api import GoogleDriveAPI
+from src.metrics import metrics
+
+
+# drive accepts at most 100 calls per batch request
+DRIVE_BATCH_LIMIT = 100
+
+
+# content stamp of a file resource, see GoogleDriveFilesystem.content_stamp
+def file_stamp(meta: dict) -> tuple:
+    return (meta.get("modifiedTime"), meta.get("md5Checksum"))
 
 
 class GoogleDriveFilesystem(HashEncoding, MetadataEncoding):
     PROPERTY_SIZE = 75
     PROPERTY_COUNT = 30
-
-    def __init__(self, cred_path: str, covert_folder_id: str):
-        # connect to google drive
+    BATCH_IO = True
+    # every poll is an api request that counts against the drive quota
+    POLL_PERIOD = .05
+    MAX_POLL_PERIOD = 2.0
+    POLL_RATE = 10
+
+    def __init__(self, cred_path: str, covert_folder_id: str, standin_url: str = None,
+                 watch_changes: bool = True):
+        # connect to google drive (or a local stand-in for offline testing)
         self.conn = GoogleDriveAPI()
-        self.conn.authenticate_drive(credentials_path=cred_path)
+        if standin_url:
+            self.conn.connect_standin(standin_url)
+        else:
+            self.conn.authenticate_drive(credentials_path=cred_path)
         self.covert_folder_id = covert_folder_id
+        # content stamps of the whole folder from a single listing. carriers
+        # only change between signals, so the listing is dropped whenever a
+        # signal is set or a new one is seen (see content_stamp)
+        self.content_stamps = None
+        self.content_stamps_lock = threading.Lock()
+        self.last_signal = None
+        # signal waits follow the changes feed instead of re-reading the sync
+        # file, the token is saved between waits so no change is missed
+        self.watch_changes = watch_changes
+        self.changes_token = None
+        self.config_changes = 0
         # finish initialization by calling super
         super().__init__()
 
-    def update_virtual_filesystem(self):
-        super().update_virtual_filesystem()
-        # clear properties of sync file
+    def update_virtual_filesystem(self) -> bool:
+        if not super().update_virtual_filesystem():
+            return False
+        # clear properties of the new sync file
         existing = self.conn.get_file_properties(self.sync_file)
         if existing:
             clear_payload = {k: None for k in existing}
             self.conn.update_properties(self.sync_file, clear_payload)
+        return True
 
     ### FILESYSTEM SPECIFIC METHODS
     def get_all_files(self) -> List[str]:
@@ -32,38 +65,134 @@ class GoogleDriveFilesystem(HashEncoding, MetadataEncoding):
         ids = [f["id"] for f in files]
         return sorted(ids)
 
-    def write_content(self, file: str, data: bytes):
-        self.conn.edit_file_bytes(file, data)
-
-    def read_content(self, file: str) -> bytes:
-        return self.conn.download_file_from_drive_bytes(file)
+    # md5Checksum pins the content, modifiedTime catches anything else.
+    # one listing validates every carrier of a batch instead of a metadata
+    # request per file, which would cost as much as downloading a small file
+    def content_stamp(self, file: str):
+        # the client count changes without any signal, always download it
+        if file == self.config_file:
+            return None
+        with self.content_stamps_lock:
+            if self.content_stamps is None:
+                with metrics.timer('medium_list'):
+                    files = self.conn.list_files(self.covert_folder_id)
+                self.content_stamps = {f["id"]: file_stamp(f) for f in files}
+            return self.content_stamps.get(file)
+
+    def store_content(self, file: str, data: bytes):
+        with metrics.timer('medium_write'):
+            stamp = file_stamp(self.conn.edit_file_bytes(file, data))
+        with self.content_stamps_lock:
+            if self.content_stamps is not None:
+                self.content_stamps[file] = stamp
+        return stamp
+
+    def fetch_content(self, file: str) -> bytes:
+        with metrics.timer('medium_read'):
+            return self.conn.download_file_from_drive_bytes(file)
+
+    def forget_content_stamps(self) -> None:
+        with self.content_stamps_lock:
+            self.content_stamps = None
 
     def write_properties(self, file: str, properties: Dict[str, str]) -> None:
-        existing = self.conn.get_file_properties(file)
-        to_update = {k: None for k in existing}
-        to_update.update(properties)
-        if to_update:
-            self.conn.update_properties(file, to_update)
+        with metrics.timer('medium_write_properties'):
+            existing = self.conn.get_file_properties(file)
+            to_update = {k: None for k in existing}
+            to_update.update(properties)
+            if to_update:
+                self.conn.update_properties(file, to_update)
 
     def read_properties(self, file: str) -> Dict[str, str]:   
-        return self.conn.get_file_properties(file)
+        with metrics.timer('medium_read_properties'):
+            return self.conn.get_file_properties(file)
 
+    # keys mapped to None are deleted, so callers can drop stale keys without a read
     def write_properties_batch(self, props_map: Dict[str, Dict[str, str]]) -> None:
-        self.conn.update_properties_batch(props_map)
+        with metrics.timer('medium_write_properties_batch'):
+            self.conn.update_properties_batch(props_map, batch_size=DRIVE_BATCH_LIMIT)
 
     def read_properties_batch(self, file_ids: List[str]) -> Dict[str, Dict[str, str]]:
-        return self.conn.get_properties_batch(file_ids)
-
-    def set_signal(self, sig: Signal) -> None:
-        print(f"[SEND] {sig.name}")
-        self.conn.update_properties(self.sync_file, {'sync_status': sig.name})
+        with metrics.timer('medium_read_properties_batch'):
+            return self.conn.get_properties_batch(file_ids, batch_size=DRIVE_BATCH_LIMIT)
+
+    # kept as an appProperty of the config file
+    def read_share_setting(self, key: str) -> str | None:
+        return self.conn.get_file_properties(self.config_file).get(key)
+
+    def write_share_setting(self, key: str, value: str) -> None:
+        self.conn.update_properties(self.config_file, {key: value})
+
+    # bumped by the changes feed, so the vfs only re-reads the config file when it changed.
+    # unknown until the feed is followed, changes before the first token are not reported
+    def get_config_stamp(self):
+        return self.config_changes if self.watch_changes and self.changes_token else None
+
+    # one changes.list request covers both the sync and the config file
+    def wait_for_signal(self, *signals: Signal) -> tuple[Signal, int]:
+        if not self.watch_changes:
+            return super().wait_for_signal(*signals)
+        # the token is taken before reading, a change right after the read is still reported
+        if self.changes_token is None:
+            self.changes_token = self.conn.get_start_page_token()
+        while True:
+            self.update_virtual_filesystem()
+            sig, arg = self.read_signal_arg()
+            if sig in signals:
+                return sig, arg
+            wait = self.poll_schedule.wait()
+            while not self.poll_changes():
+                wait.sleep()
+
+    # consumes the changes feed, returns True if the sync or config file changed
+    def poll_changes(self) -> bool:
+        with metrics.timer('medium_changes'):
+            changes, self.changes_token = self.conn.list_changes(self.changes_token)
+        changed = {change.get('fileId') for change in changes}
+        if self.config_file in changed:
+            self.config_changes += 1
+        return self.sync_file in changed or self.config_file in changed
+
+    def set_signal(self, sig: Signal, arg: int = None, file: str = None) -> None:
+        metrics.event('signal_set', signal=sig.name, arg=arg)
+        self.poll_schedule.expect_reply()
+        self.forget_content_stamps()
+        props = {'sync_status': sig.name}
+        # an arg-less signal drops the arg, or readers would see the previous one
+        props['sync_arg'] = None if arg is None else str(arg)
+        if file is not None:
+            # a released slot still holds the chunks its last channel wrote there
+            props = {k: None for k in self.conn.get_file_properties(file)} | props
+        self.conn.update_properties(file or self.sync_file, props)
 
     def read_signal(self) -> Signal:
+        return self.read_signal_arg()[0]
+
+    def read_signal_arg(self) -> tuple[Signal, int]:
         props = self.conn.get_file_properties(self.sync_file)
         status = props.get('sync_status')
+        arg = int(props.get('sync_arg', 0))
+        # the peer is done writing whatever it wrote before this signal
+        if (status, arg) != self.last_signal:
+            self.last_signal = (status, arg)
+            self.forget_content_stamps()
+        return self.parse_signal(status, arg)
+
+    def parse_signal(self, status: str, arg: int) -> tuple[Signal, int]:
         if status in Signal.__members__:
-            return Signal[status]
-        return Signal.CLEAR
+            return Signal[status], arg
+        return Signal.CLEAR, arg
+
+    # follows the changes feed like wait_for_signal, the sync file is only
+    # read again when it or the config file changed since the last poll
+    def poll_signal(self) -> tuple[Signal, int]:
+        if not self.watch_changes:
+            return super().poll_signal()
+        if self.changes_token is None:
+            self.changes_token = self.conn.get_start_page_token()
+        elif self.last_signal and not self.poll_changes():
+            return self.parse_signal(*self.last_signal)
+        return super().poll_signal()
 
     def clear_all_metadata(self) -> None:
         all_files = self.conn.list_files(directory_id=self.covert_folder_id)
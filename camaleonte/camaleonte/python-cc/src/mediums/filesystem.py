@@ -1,12 +1,35 @@
-import math, time
+import threading, time
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from enum import Enum
-import math
+from src.metrics import metrics
 from src.utils import set_hash_byte, get_hash_byte
 
 
 # will poll sync file at max 60 times per second
 POLL_SYNC_FILE_PERIOD = 1/60
+# signal waits keep polling fast for this long after we signalled the peer,
+# then back off (see PollSchedule)
+POLL_IDLE_AFTER = 1.0
+
+# client count is re-read at least every N vfs updates even if the config looks unchanged
+VFS_CHECK_INTERVAL = 16
+
+# signals can carry an integer argument (e.g. windowed ack masks) of this width
+SIGNAL_ARG_BITS = 24
+
+# the property layout picked by MetadataEncoding.tune_properties() is stored
+# with the share (on the config file) so every peer uses the same one
+CAPACITY_SETTING = "capacity"
+# probe bounds, values are measured as stored (base64) lengths
+PROBE_MAX_VALUE = 1 << 15
+PROBE_MIN_VALUE = 16
+PROBE_MAX_COUNT = 64
+PROBE_TRIALS = 5
+
+# read_content() keeps up to this many bytes of file contents, least
+# recently used first out
+CONTENT_CACHE_BYTES = 32 * 1024 * 1024
 
 
 class Signal(Enum):
@@ -14,13 +37,161 @@ class Signal(Enum):
     ACK = 1
     NACK = 2
     DONE = 3
+    # epoch layouts only: the files of this slot were given up by the channel
+    # that held them, the arg is the layout level they were released at
+    RELEASED = 4
+
+
+# number of slices for `count` clients, the next power of two
+def layout_level(count: int) -> int:
+    return 1 if count <= 1 else 1 << (count - 1).bit_length()
+
+
+# file -> (stamp, data) where the stamp is whatever content_stamp() returned
+# when the data was read. guarded by a lock since protocol workers share it
+class ContentCache:
+    def __init__(self, max_bytes: int = CONTENT_CACHE_BYTES) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, file: str, stamp) -> bytes | None:
+        with self.lock:
+            entry = self.entries.get(file)
+            if entry is None or entry[0] != stamp:
+                return None
+            self.entries.move_to_end(file)
+            return entry[1]
+
+    def put(self, file: str, stamp, data: bytes) -> None:
+        with self.lock:
+            self.discard_locked(file)
+            if len(data) > self.max_bytes:
+                return
+            self.entries[file] = (stamp, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, old) = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+    def discard(self, file: str) -> None:
+        with self.lock:
+            self.discard_locked(file)
+
+    def discard_locked(self, file: str) -> None:
+        entry = self.entries.pop(file, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+# token bucket allowing `rate` requests per second on average and bursts of
+# up to `burst`. callers over budget are made to wait for their turn
+class RequestBudget:
+    # one budget per medium kind, shared by every filesystem in the process
+    budgets = {}
+    budgets_lock = threading.Lock()
+
+    def __init__(self, rate: float, burst: float = None) -> None:
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_medium(cls, name: str, rate: float):
+        if rate is None:
+            return None
+        with cls.budgets_lock:
+            if name not in cls.budgets:
+                cls.budgets[name] = cls(rate)
+            return cls.budgets[name]
+
+    def acquire(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            # take the token now and sleep off the debt, so waiters queue fairly
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            metrics.count('poll_budget_waits')
+            time.sleep(delay)
+
+
+# shared wait/backoff scheduler for signal and connection waits. polls every
+# `period` while a reply is expected (for `idle_after` seconds after we set a
+# signal) and doubles the period up to `max_period` once the channel is idle
+class PollSchedule:
+    def __init__(self, period: float, max_period: float, idle_after: float,
+                 budget: RequestBudget = None) -> None:
+        self.period = period
+        self.max_period = max_period
+        self.idle_after = idle_after
+        self.budget = budget
+        self.active_until = 0.0
+
+    # we just signalled the peer, its answer should follow shortly
+    def expect_reply(self) -> None:
+        self.active_until = time.monotonic() + self.idle_after
+
+    def wait(self) -> 'PollWait':
+        return PollWait(self)
+
+
+# the backoff state of a single wait
+class PollWait:
+    def __init__(self, schedule: PollSchedule) -> None:
+        self.schedule = schedule
+        self.period = schedule.period
+
+    # something changed, go back to polling fast
+    def reset(self) -> None:
+        self.period = self.schedule.period
+
+    def next_period(self) -> float:
+        period = self.period
+        if time.monotonic() >= self.schedule.active_until:
+            self.period = min(self.period * 2, self.schedule.max_period)
+        return period
+
+    # sleeps until the next poll may be sent
+    def sleep(self) -> None:
+        time.sleep(self.next_period())
+        self.acquire()
+
+    def acquire(self) -> None:
+        if self.schedule.budget:
+            self.schedule.budget.acquire()
 
 
 class Filesystem(ABC):
+    # signal wait polling, see PollSchedule. POLL_RATE caps the polls per
+    # second of all filesystems of this kind in the process (None: no cap)
+    POLL_PERIOD = POLL_SYNC_FILE_PERIOD
+    MAX_POLL_PERIOD = .25
+    POLL_RATE = None
+
     def __init__(self) -> None:
+        self.poll_schedule = PollSchedule(
+            self.POLL_PERIOD, self.MAX_POLL_PERIOD, POLL_IDLE_AFTER,
+            RequestBudget.for_medium(type(self).__name__, self.POLL_RATE))
+        self.content_cache = ContentCache()
         self.channel_pos = -1
         self.client_count = 0 # this is used to optmize VFS calculation
         self.config_file = self.get_all_files()[0]
+        # bumped every time the vfs is repartitioned
+        self.vfs_version = 0
+        self.vfs_polls = 0
+        self.config_stamp = None
+        # number of slices the files are split in (a power of two, 0 before joining)
+        self.layout_level = 0
+        # epoch layouts (see Protocol): nested slices, and client count changes
+        # only raise pending_level until the protocol switches
+        self.epochs = False
+        self.pending_level = 0
 
     def get_files(self) -> list[str]:
         self.update_virtual_filesystem()
@@ -38,37 +209,127 @@ class Filesystem(ABC):
     def set_channel_pos(self, pos: int) -> None:
         self.channel_pos = pos
 
-    def update_virtual_filesystem(self) -> None:
+    # cheap token that changes whenever the config file does, None if unknown
+    def get_config_stamp(self):
+        return None
+
+    # returns True if the vfs was repartitioned
+    def update_virtual_filesystem(self) -> bool:
         if self.channel_pos == -1:
             raise Exception("Didn't connect or wait for connection!")
+        # skip reading the config file while the stamp is unchanged, but
+        # still re-read every VFS_CHECK_INTERVAL calls
+        self.vfs_polls += 1
+        stamp = self.get_config_stamp()
+        if self.vfs_version and stamp is not None and stamp == self.config_stamp \
+                and self.vfs_polls < VFS_CHECK_INTERVAL:
+            return False
+        self.vfs_polls = 0
+        self.config_stamp = stamp
         # only update if client count changed
         new_client_cnt = self.get_client_count()
         if self.client_count  == new_client_cnt:
-            return
+            return False
         self.client_count = new_client_cnt
-        # calculate upper and lower bounds using geometric sequence formula
-        all_files = self.get_all_files()
-        base = 1
-        ratio = 2
-        if self.client_count <= base:
-            max_clients = 1
-        else:
-            exponent = math.ceil(math.log(self.client_count/base,ratio))
-            max_clients = base * (ratio**exponent)
-        files_per_client = (len(all_files)-1) // max_clients
-        start_index = self.channel_pos * files_per_client + 1
+        level = layout_level(new_client_cnt)
+        if self.epochs:
+            # the protocol moves over at a batch boundary, see Protocol.switch_steps()
+            self.pending_level = max(self.pending_level, level)
+            return False
+        # clients that fit in the current layout leave the slices alone
+        if level == self.layout_level:
+            return False
+        self.set_layout(level)
+        # set the signal of sync file to clear to avoid unintential read/write
+        self.set_signal(Signal.CLEAR)
+        return True
+
+    # partitions the files into `level` slices (a power of two) and takes
+    # the one of this channel
+    def set_layout(self, level: int) -> None:
+        self.layout_level = level
+        self.pending_level = max(self.pending_level, level)
+        self.vfs_version += 1
         # set the virtual_filesystem using the calculated bounds
-        self.virtual_filesystem = all_files[start_index:start_index+files_per_client]
+        self.virtual_filesystem = self.slot_files(self.channel_pos, level)
         # select the sync file as the first file in the vfs
         self.sync_file = self.virtual_filesystem[0]
-        # set the signal of sync file to clear to avoid unintential read/write
-        self.set_signal(Signal.CLEAR)
-        print("SYNC FILE: ", self.sync_file, start_index, start_index+files_per_client)  # DEBUG
+        metrics.event('vfs_update', sync_file=self.sync_file, level=level,
+                      client_count=self.client_count)
+
+    # the slice of `channel` when the files are split in `level` slices
+    def slot_files(self, channel: int, level: int) -> list[str]:
+        all_files = self.get_all_files()
+        count = len(all_files) - 1
+        if not self.epochs:
+            files_per_client = count // level
+            start_index = channel * files_per_client + 1
+            return all_files[start_index:start_index + files_per_client]
+        # slots go in bit reversed channel order, so every new level halves
+        # each slice in place: channels keep their sync file and the ones
+        # that join take the tails
+        bits = level.bit_length() - 1
+        slot = int(format(channel, f'0{bits}b')[::-1], 2) if bits else 0
+        return all_files[1 + slot * count // level:1 + (slot + 1) * count // level]
+
+    # hands the tails this channel gave up since layout `level` to the
+    # channels that take them (see Protocol.join_steps)
+    def release_slots(self, level: int) -> None:
+        for channel in range(self.channel_pos + level, self.layout_level, level):
+            file = self.slot_files(channel, self.layout_level)[0]
+            metrics.event('slot_released', channel=channel, level=self.layout_level)
+            self.set_signal(Signal.RELEASED, self.layout_level, file)
+
+    ### CONTENT CACHE
+    # read through the cache, only trusting an entry while the medium's
+    # stamp for the file is unchanged. mediums return a None stamp for
+    # files they cannot (or would rather not) validate, those always go
+    # to the medium
+    def read_content(self, file: str) -> bytes:
+        stamp = self.content_stamp(file)
+        if stamp is None:
+            return self.fetch_content(file)
+        data = self.content_cache.get(file, stamp)
+        if data is not None:
+            metrics.count('content_cache_hits')
+            return data
+        metrics.count('content_cache_misses')
+        # the stamp is taken first, a change racing the fetch only costs a miss
+        data = self.fetch_content(file)
+        self.content_cache.put(file, stamp, data)
+        return data
+
+    def write_content(self, file: str, data: bytes) -> None:
+        stamp = self.store_content(file, data)
+        if stamp is None:
+            self.content_cache.discard(file)
+        else:
+            self.content_cache.put(file, stamp, data)
+
+    # cheap token that changes whenever the content does, None to bypass the cache
+    def content_stamp(self, file: str):
+        return None
+
+    # blocks until the sync file holds one of the given signals
+    def wait_for_signal(self, *signals: Signal) -> tuple[Signal, int]:
+        wait = self.poll_schedule.wait()
+        while True:
+            sig, arg = self.read_signal_arg()
+            if sig in signals:
+                return sig, arg
+            wait.sleep()
+
+    # one look at the sync file for pollers that do their own waiting (see SignalPoller)
+    def poll_signal(self) -> tuple[Signal, int]:
+        self.update_virtual_filesystem()
+        return self.read_signal_arg()
 
     # Abstract interface
     @abstractmethod
     def get_all_files(self) -> list[str]: pass
 
+    # implemented as set_signal(sig, arg=None, file=None), arg is only written
+    # when not None and file defaults to the sync file
     @abstractmethod
     def set_signal(self) -> Signal:
         self.update_virtual_filesystem()
@@ -80,11 +341,19 @@ class Filesystem(ABC):
         self.update_virtual_filesystem()
         pass
 
+    # returns the signal together with the argument it was set with
     @abstractmethod
-    def write_content(self, file: str, data: bytes) -> None: pass
+    def read_signal_arg(self) -> tuple[Signal, int]:
+        time.sleep(POLL_SYNC_FILE_PERIOD)
+        self.update_virtual_filesystem()
+        pass
+
+    # returns the stamp of the written content if it is known without another request
+    @abstractmethod
+    def store_content(self, file: str, data: bytes): pass
 
     @abstractmethod
-    def read_content(self, file: str) -> bytes: pass
+    def fetch_content(self, file: str) -> bytes: pass
 
 
 class HashEncoding(Filesystem):
@@ -92,6 +361,11 @@ class HashEncoding(Filesystem):
 
 
 class MetadataEncoding(Filesystem):
+    # mediums setting this implement write_properties_batch/read_properties_batch
+    BATCH_IO = False
+    # mediums setting this store raw bytes values and accept read_properties(file, raw=True)
+    BINARY_PROPERTIES = False
+
     @property
     @abstractmethod
     def PROPERTY_SIZE(self) -> int: pass
@@ -105,3 +379,85 @@ class MetadataEncoding(Filesystem):
 
     @abstractmethod
     def read_properties(self, file: str) -> dict: pass
+
+    # small settings kept with the share itself, outside the covert properties
+    @abstractmethod
+    def read_share_setting(self, key: str) -> str | None: pass
+
+    @abstractmethod
+    def write_share_setting(self, key: str, value: str) -> None: pass
+
+    ### CAPACITY PROBE
+    # use the measured property layout of this share, probing it the first time
+    def tune_properties(self, refresh: bool = False) -> tuple[int, int]:
+        layout = None if refresh else self.load_properties()
+        if layout:
+            return layout
+        size, count = self.probe_properties(self.config_file)
+        self.write_share_setting(CAPACITY_SETTING, f"{size},{count}")
+        self.PROPERTY_SIZE = size
+        self.PROPERTY_COUNT = count
+        metrics.event('property_layout', count=count, size=size, probed=True)
+        return size, count
+
+    # use the layout stored with the share if a peer probed it, both ends
+    # must agree on it. returns None and keeps the defaults otherwise
+    def load_properties(self) -> tuple[int, int] | None:
+        setting = self.read_share_setting(CAPACITY_SETTING)
+        if not setting:
+            return None
+        size, count = (int(x) for x in setting.split(','))
+        self.PROPERTY_SIZE = size
+        self.PROPERTY_COUNT = count
+        metrics.event('property_layout', count=count, size=size, probed=False)
+        return size, count
+
+    # finds how many properties fit, then the largest accepted value for
+    # doubling counts up to that, and keeps the layout with the best timed
+    # write+read throughput. the config file is used as scratch space
+    def probe_properties(self, file: str) -> tuple[int, int]:
+        best, best_rate = (self.PROPERTY_SIZE, self.PROPERTY_COUNT), 0.0
+        max_count = self.probe_limit(lambda n: self.probe_write(file, PROBE_MIN_VALUE, n), PROBE_MAX_COUNT)
+        counts = {1 << i for i in range(max_count.bit_length())} | {max_count}
+        for count in sorted(counts - {0}):
+            stored = self.probe_limit(lambda n: self.probe_write(file, n, count), PROBE_MAX_VALUE)
+            # whole base64 quads only
+            stored -= stored % 4
+            if stored < PROBE_MIN_VALUE:
+                continue
+            # best of a few trials, the mean is too noisy on fast mounts
+            elapsed = float('inf')
+            for _ in range(PROBE_TRIALS):
+                start = time.perf_counter()
+                self.probe_write(file, stored, count)
+                self.read_properties(file)
+                elapsed = min(elapsed, time.perf_counter() - start)
+            size = stored // 4 * 3
+            rate = size * count / elapsed
+            if rate > best_rate:
+                best, best_rate = (size, count), rate
+        self.write_properties(file, {})
+        return best
+
+    def probe_write(self, file: str, stored: int, count: int) -> bool:
+        try:
+            self.write_properties(file, {f'hash_{i}': 'A' * stored for i in range(count)})
+            return True
+        except Exception:
+            return False
+
+    # largest n in [1, high] that accepted(n), 0 if none
+    def probe_limit(self, accepted, high: int) -> int:
+        low = 0
+        step = 1
+        # grow exponentially, then bisect
+        while step <= high and accepted(step):
+            low, step = step, step * 2
+        high = min(high, step - 1)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if accepted(mid):
+                low = mid
+            else:
+                high = mid - 1
+        return low
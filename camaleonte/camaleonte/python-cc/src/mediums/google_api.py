@@ -1,28 +1,101 @@
 import io
+import json
 import os
+import threading
 import time
+from datetime import datetime, timezone
+
+import httplib2
 
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp, Request
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.http import (
     MediaFileUpload,
     MediaIoBaseUpload,
-    MediaIoBaseDownload,
 )
 
 from googleapiclient.errors import HttpError
-import time
+from src.metrics import metrics
 
 SCOPES = ['https://www.googleapis.com/auth/drive']
 TOKEN_PATH = "creds/token.json"
 
+# socket timeout of every session, a hung connection would stall a worker for good
+HTTP_TIMEOUT = 60
+# the access token is refreshed in the background this long before it expires
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_RETRY_DELAY = 30
+
 
 class GoogleDriveAPI:
     """A wrapper for Google Drive API v3."""
 
     def __init__(self):
-        self.service_worker = None
+        # discovery document the services are built from, set once authenticated
+        self.discovery = None
+        # None when talking to a stand-in
+        self.credentials = None
+        self.local = threading.local()
+        self.refresh_timer = None
+
+    @property
+    def service_worker(self):
+        """
+        The Drive service for the calling thread. Service objects and their
+        httplib2 transport are not thread safe, so each thread gets its own
+        authorized session. Sessions live as long as their thread, so the
+        keep-alive connection (and its TLS session) is reused by every call.
+        """
+        if self.discovery is None:
+            return None
+        service = getattr(self.local, 'service', None)
+        if service is None:
+            service = self.local.service = build_from_document(self.discovery, http=self.new_session())
+            metrics.count('drive_sessions')
+        return service
+
+    def new_session(self) -> httplib2.Http:
+        """
+        Builds the HTTP transport of one worker. All sessions share the
+        credentials object, see refresh_token().
+        """
+        http = httplib2.Http(timeout=HTTP_TIMEOUT)
+        if self.credentials is None:
+            return http
+        return AuthorizedHttp(self.credentials, http=http)
+
+    def refresh_token(self) -> None:
+        """
+        Refreshes the access token ahead of its expiry, then schedules the next
+        refresh on a background timer. Workers keep sending the current (still
+        valid) token meanwhile, so no call waits on a refresh and concurrent
+        workers never race each other to refresh an expired token.
+        """
+        creds = self.credentials
+        delay = TOKEN_RETRY_DELAY
+        try:
+            if not creds.valid or self.token_lifetime() < TOKEN_REFRESH_MARGIN:
+                creds.refresh(Request(httplib2.Http(timeout=HTTP_TIMEOUT)))
+                metrics.count('token_refreshes')
+            if creds.expiry is None:
+                return
+            delay = max(self.token_lifetime() - TOKEN_REFRESH_MARGIN, TOKEN_RETRY_DELAY)
+        except Exception as e:
+            print(f"[ERROR] token refresh failed, retrying in {delay}s: {e}")
+        self.refresh_timer = threading.Timer(delay, self.refresh_token)
+        self.refresh_timer.daemon = True
+        self.refresh_timer.start()
+
+    def token_lifetime(self) -> float:
+        """Seconds until the access token expires (inf if it does not)."""
+        if self.credentials.expiry is None:
+            return float('inf')
+        # google-auth keeps expiry as naive UTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return (self.credentials.expiry - now).total_seconds()
 
     def authenticate_drive(self, credentials_path: str) -> None:
         """
@@ -36,8 +109,23 @@ class GoogleDriveAPI:
             with open(TOKEN_PATH, 'w') as token_file:
                 token_file.write(creds.to_json())
 
-        creds = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
-        self.service_worker = build('drive', 'v3', credentials=creds)
+        self.credentials = Credentials.from_authorized_user_file(TOKEN_PATH, SCOPES)
+        # parsed once, every worker builds its service from it
+        self.discovery = json.loads(get_static_doc('drive', 'v3'))
+        self.refresh_token()
+
+    def connect_standin(self, root_url: str) -> None:
+        """
+        Points the wrapper at a local Drive stand-in (helpers/drive_standin.py)
+        instead of Google. No credentials are used.
+
+        Args:
+            root_url: Base URL of the stand-in, e.g. http://127.0.0.1:8765/
+        """
+        discovery = json.loads(get_static_doc('drive', 'v3'))
+        # media uploads and batch requests are built from rootUrl, not api_endpoint
+        discovery['rootUrl'] = root_url
+        self.discovery = discovery
 
     def upload_file_to_drive(self, file_path: str, destination_id: str) -> None:
         """
@@ -63,14 +151,9 @@ class GoogleDriveAPI:
             target_id: ID of the Drive file.
         """
         assert self.service_worker, "Authenticate first."
-        request = self.service_worker.files().get_media(fileId=target_id)
-        buffer = io.BytesIO()
-        downloader = MediaIoBaseDownload(buffer, request)
-        done = False
-        while not done:
-            status, done = downloader.next_chunk()
-        buffer.seek(0)
-        return buffer.read()
+        # one alt=media request, the body comes back as bytes without the
+        # chunked downloader and its buffer copies
+        return self.service_worker.files().get_media(fileId=target_id).execute()
 
     def download_file_from_drive(self, destination: str, target_id: str) -> None:
         """
@@ -143,7 +226,7 @@ class GoogleDriveAPI:
                 orderBy="name",
                 pageSize=1000,
                 pageToken=page_token,
-                fields="nextPageToken, files(id,name,mimeType,parents)"
+                fields="nextPageToken, files(id,name,mimeType,parents,modifiedTime,md5Checksum)"
             ).execute()
             all_files.extend(resp.get('files', []))
             page_token = resp.get('nextPageToken')
@@ -152,6 +235,37 @@ class GoogleDriveAPI:
 
         return all_files
 
+    def get_start_page_token(self) -> str:
+        """
+        Returns a changes page token, list_changes() from it reports every
+        change made after this call.
+        """
+        assert self.service_worker, "Authenticate first."
+        resp = self.service_worker.changes().getStartPageToken().execute()
+        return resp['startPageToken']
+
+    def list_changes(self, page_token: str) -> tuple[list[dict], str]:
+        """
+        Lists the changes made since a page token, following every page.
+
+        Args:
+            page_token: Token from get_start_page_token() or a previous call.
+
+        Returns:
+            (changes with fileId and removed, token to continue from)
+        """
+        assert self.service_worker, "Authenticate first."
+        changes = []
+        while True:
+            resp = self.service_worker.changes().list(
+                pageToken=page_token, pageSize=1000, spaces='drive',
+                fields='nextPageToken,newStartPageToken,changes(fileId,removed)'
+            ).execute()
+            changes.extend(resp.get('changes', []))
+            if 'newStartPageToken' in resp:
+                return changes, resp['newStartPageToken']
+            page_token = resp['nextPageToken']
+
     def watch_file(self, target_id: str, poll_interval=0.1, timeout=300) -> bool:
         """
         Polls a file until modified or trashed.
@@ -192,20 +306,23 @@ class GoogleDriveAPI:
             fileId=target_id, media_body=media
         ).execute()
 
-    def edit_file_bytes(self, target_id: str, bytes_: bytes) -> None:
+    def edit_file_bytes(self, target_id: str, bytes_: bytes) -> dict:
         """
         Replaces file content with in-memory bytes.
 
         Args:
             target_id: Drive file ID.
             bytes_: Byte data or BytesIO.
+
+        Returns:
+            Dict with the new modifiedTime and md5Checksum.
         """
         assert self.service_worker, "Authenticate first."
         buffer = bytes_ if isinstance(bytes_, io.BytesIO) else io.BytesIO(bytes_)
         buffer.seek(0)
         media = MediaIoBaseUpload(buffer, mimetype='application/octet-stream', resumable=False)
-        self.service_worker.files().update(
-            fileId=target_id, media_body=media
+        return self.service_worker.files().update(
+            fileId=target_id, media_body=media, fields='modifiedTime,md5Checksum'
         ).execute()
 
     def delete_file(self, target_id: str) -> None:
@@ -309,29 +426,30 @@ class GoogleDriveAPI:
                 # exhausted retries
                 print(f"[FAIL] batch #{start//batch_size+1} failed after {max_retries} attempts.")
                
-    def get_properties_batch(self, file_ids: list[str]) -> dict:
+    def get_properties_batch(self, file_ids: list[str], batch_size: int = 100) -> dict:
         """
-        Retrieves appProperties for multiple files in one batch.
+        Retrieves appProperties for multiple files, batch_size files per
+        batch request.
 
         Args:
             file_ids: List of Drive file IDs.
+            batch_size: Max requests per batch (Drive allows 100).
         Returns:
             { file_id: appProperties dict, … }
         """
         assert self.service_worker, "Authenticate first."
         out = {}
 
-        batch = self.service_worker.new_batch_http_request()
-
         def _cb(req_id, resp, exc):
             if not exc:
                 out[resp['id']] = resp.get('appProperties', {})
 
-        for fid in file_ids:
-            req = self.service_worker.files().get(
-                fileId=fid, fields='id,appProperties'
-            )
-            batch.add(req, callback=_cb)
-
-        batch.execute()
+        for start in range(0, len(file_ids), batch_size):
+            batch = self.service_worker.new_batch_http_request()
+            for fid in file_ids[start:start + batch_size]:
+                req = self.service_worker.files().get(
+                    fileId=fid, fields='id,appProperties'
+                )
+                batch.add(req, callback=_cb)
+            batch.execute()
         return out
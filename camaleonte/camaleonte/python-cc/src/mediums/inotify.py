@@ -0,0 +1,64 @@
+import ctypes, ctypes.util
+import os, select
+
+
+# inotify(7) event masks
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVE_SELF = 0x800
+IN_DELETE_SELF = 0x400
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVE_SELF | IN_DELETE_SELF
+
+
+# minimal ctypes wrapper around inotify so waiting does not need a dependency
+# NOTE: inotify only sees local changes, remote NFS writes never fire events
+class Inotify:
+    def __init__(self) -> None:
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    # replace the watched paths, keeping watches that did not change
+    def watch(self, paths: list[str]) -> None:
+        for path in list(self.watches):
+            if path not in paths:
+                self.libc.inotify_rm_watch(self.fd, self.watches.pop(path))
+        for path in paths:
+            if path in self.watches:
+                continue
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed on {path}")
+            self.watches[path] = wd
+
+    # returns True if any watched file changed before the timeout
+    def wait(self, timeout: float) -> bool:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        # drain the queued events, we only care that something happened
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __del__(self) -> None:
+        self.close()
+
+
+# returns None where inotify is not available (non linux, fd limits reached)
+def create_inotify() -> Inotify | None:
+    try:
+        return Inotify()
+    except (OSError, AttributeError, TypeError):
+        return None
@@ -1,10 +1,33 @@
 import os
+import struct
 import time
 
-from .filesystem import HashEncoding, MetadataEncoding, Signal
-from src.utils import get_hash_byte, set_hash_byte
+from .filesystem import HashEncoding, MetadataEncoding, Signal, SIGNAL_ARG_BITS
+from .inotify import create_inotify
+from src.metrics import metrics
+from src.utils import set_hash_byte, get_hash_bits, set_hash_bits
 
 
+# mtimes may only tick once a second, so a second write in the same tick
+# with the same size would look unchanged. like git's racy index entries, a
+# cached file whose mtime is not older than the (truncated) time it was
+# fetched at is read again
+MTIME_TICK_NS = 1_000_000_000
+
+# packed layout: all properties of a file live in a few large xattrs
+# (user.hash, user.hash.1, ...) instead of one xattr per property.
+# the largest value differs per filesystem (about 4000 bytes shared by
+# every xattr of a file on ext4, 64 KiB on xfs), so the first peer probes
+# it and stores it as a share setting, see packed_xattr_size()
+PACKED_XATTR = "user.hash"
+PACKED_SIZE_SETTING = "packed_xattr_size"
+# linux refuses larger values on every filesystem (XATTR_SIZE_MAX)
+PACKED_MAX_SIZE = 1 << 16
+# blob: total length, then (key length, key, value length, value) entries
+PACKED_LENGTH = struct.Struct('<I')
+PACKED_KEY = struct.Struct('<B')
+PACKED_VALUE = struct.Struct('<H')
+
 # TODO: Add client disconnect code + other contingencies
 #       Contingency 1: Client disconnect
 #       Contingency 2: New client wants to connect while other clients sending message
@@ -12,14 +35,24 @@ from src.utils import get_hash_byte, set_hash_byte
 class LinuxFileSystem(HashEncoding, MetadataEncoding):
     PROPERTY_SIZE = 256
     PROPERTY_COUNT = 10
+    # xattr values are plain bytes
+    BINARY_PROPERTIES = True
 
-    def __init__(self, root_path: str) -> None:
+    def __init__(self, root_path: str, packed_xattrs: bool = False) -> None:
         # check if valid root path
         if not os.path.isdir(root_path):
             raise ValueError("Invalid filesystem path provided!")
         if root_path[-1] != '/':
             root_path += '/'
         self.root_path = root_path
+        # used to wake signal waits on file changes, None falls back to polling
+        self.inotify = create_inotify()
+        # one xattr per property is what the ruby port reads, packing is opt-in
+        self.packed_xattrs = packed_xattrs
+        # slot size of the packed layout, probed or read on first use
+        self.packed_size = None
+        # file -> time its content was last fetched, see content_stamp()
+        self.fetched_ns = {}
 
         # finish initialization by calling super
         super().__init__()
@@ -32,50 +65,271 @@ class LinuxFileSystem(HashEncoding, MetadataEncoding):
                 files.append(m.path)
         return sorted(files)
 
-    def read_content(self, filepath: str) -> bytes:
+    def content_stamp(self, filepath: str):
+        # the peer tells us everything through the sync and config files,
+        # they are always read
+        if filepath == self.config_file or filepath == getattr(self, 'sync_file', None):
+            return None
+        # open() makes nfs revalidate the attributes (close-to-open), a plain
+        # stat() may answer from its attribute cache for seconds
         with open(filepath, 'rb') as fil:
-            return fil.read()
+            st = os.fstat(fil.fileno())
+        fetched = self.fetched_ns.get(filepath)
+        if fetched is not None and st.st_mtime_ns >= fetched - fetched % MTIME_TICK_NS:
+            self.content_cache.discard(filepath)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def fetch_content(self, filepath: str) -> bytes:
+        self.fetched_ns[filepath] = time.time_ns()
+        with metrics.timer('medium_read'):
+            with open(filepath, 'rb') as fil:
+                return fil.read()
+
+    # overwrite in place instead of truncating first: a reader woken mid-write
+    # would otherwise see an empty file, whose crc decodes as Signal.CLEAR.
+    # mined content only grows, so only truncate when it actually shrank, a
+    # blind truncate could cut off a peer's signal written right after ours
+    # the file was just modified, so it is read again next time anyway
+    def store_content(self, filepath: str, data: bytes) -> None:
+        with metrics.timer('medium_write'):
+            with open(filepath, 'r+b') as fil:
+                old_size = os.fstat(fil.fileno()).st_size
+                fil.write(data)
+                if len(data) < old_size:
+                    fil.truncate()
 
-    def write_content(self, filepath: str, data: bytes) -> None:
-        with open(filepath, 'wb') as fil:
-            fil.write(data)
+    # a stat is far cheaper than reading and hashing the config file
+    def get_config_stamp(self):
+        st = os.stat(self.config_file)
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
 
-    def write_properties(self, filepath: str, properties: dict[str, str]) -> None:
+    def write_properties(self, filepath: str, properties: dict[str, str | bytes]) -> None:
+        with metrics.timer('medium_write_properties'):
+            if self.packed_xattrs:
+                return self.write_packed_properties(filepath, properties)
+            self.clear_properties(filepath)
+            # write data to each property
+            for key, val in properties.items():
+                attr_name = f"user.{key}"
+                os.setxattr(filepath, attr_name, val if isinstance(val, bytes) else val.encode())
+
+    def clear_properties(self, filepath: str) -> None:
         # clear any old covertdata* attrs
         for attr in os.listxattr(filepath):
             if attr.startswith("user.hash"):
                 os.removexattr(filepath, attr)
-        # write data to each property
+
+    def read_properties(self, filepath: str, raw: bool = False) -> dict[str, str | bytes]:
+        with metrics.timer('medium_read_properties'):
+            if self.packed_xattrs:
+                out = self.read_packed_properties(filepath)
+                return out if raw else {key: val.decode('utf-8', errors='replace') for key, val in out.items()}
+            out = {}
+            # loop through all properties
+            for attr in os.listxattr(filepath):
+                if attr.startswith("user.hash"):
+                    val = os.getxattr(filepath, attr)
+                    out[attr.split("user.", 1)[1]] = val if raw else val.decode('utf-8')
+            return out
+
+    # kept as a user.<key> xattr on the config file
+    def read_share_setting(self, key: str) -> str | None:
+        try:
+            return os.getxattr(self.config_file, f"user.{key}").decode()
+        except OSError:
+            return None
+
+    def write_share_setting(self, key: str, value: str) -> None:
+        os.setxattr(self.config_file, f"user.{key}", value.encode())
+
+    ### PACKED XATTRS
+    # a handful of getxattr/setxattr calls per file instead of a
+    # listxattr, a removexattr per old key and a setxattr per new key
+    def write_packed_properties(self, filepath: str, properties: dict[str, str | bytes]) -> None:
+        blob = bytearray()
         for key, val in properties.items():
-            attr_name = f"user.{key}"
-            os.setxattr(filepath, attr_name, val.encode())
+            key = key.encode()
+            val = val if isinstance(val, bytes) else val.encode()
+            blob += PACKED_KEY.pack(len(key)) + key + PACKED_VALUE.pack(len(val)) + val
+        blob = PACKED_LENGTH.pack(len(blob)) + blob
+        size = self.packed_xattr_size()
+        slots = [blob[i:i + size] for i in range(0, len(blob), size)]
+        if not properties:
+            slots = []
+        old_first = self.get_packed_slot(filepath, 0)
+        if old_first is None:
+            # first packed write, drop per key attrs left by the other layout
+            self.clear_properties(filepath)
+            old_count = 0
+        else:
+            old_count = self.packed_slot_count(filepath, old_first)
+        # free stale slots first, a failed earlier write may have left some out
+        for i in range(len(slots), old_count):
+            try:
+                os.removexattr(filepath, self.packed_slot_name(i))
+            except OSError:
+                pass
+        # only rewrite the slots that changed, the first one (holding the
+        # length) last so it never points at slots that were not written
+        try:
+            for i in reversed(range(len(slots))):
+                if i == 0:
+                    old = old_first
+                elif i < old_count:
+                    old = self.get_packed_slot(filepath, i)
+                else:
+                    old = None
+                if old != slots[i]:
+                    os.setxattr(filepath, self.packed_slot_name(i), slots[i])
+        except OSError:
+            # out of xattr space, drop new slots the old first slot does not know about
+            for i in range(max(old_count, 1), len(slots)):
+                try:
+                    os.removexattr(filepath, self.packed_slot_name(i))
+                except OSError:
+                    pass
+            raise
 
-    def read_properties(self, filepath: str) -> dict[str, str]:
+    # damaged blobs are parsed up to the first truncated entry, the batch
+    # checksum then rejects them like any other damaged carrier
+    def read_packed_properties(self, filepath: str) -> dict[str, bytes]:
+        blob = self.get_packed_slot(filepath, 0)
+        if blob is None or len(blob) < PACKED_LENGTH.size:
+            return {}
+        for i in range(1, self.packed_slot_count(filepath, blob)):
+            blob += self.get_packed_slot(filepath, i) or b''
         out = {}
-        # loop through all properties
-        for attr in os.listxattr(filepath):
-            if attr.startswith("user.hash"):
-                raw = os.getxattr(filepath, attr)
-                out[attr.split("user.", 1)[1]] = raw.decode('utf-8')
+        pos = PACKED_LENGTH.size
+        end = min(len(blob), PACKED_LENGTH.size + PACKED_LENGTH.unpack_from(blob)[0])
+        while pos + PACKED_KEY.size <= end:
+            key_len, = PACKED_KEY.unpack_from(blob, pos)
+            pos += PACKED_KEY.size
+            if pos + key_len + PACKED_VALUE.size > end:
+                break
+            key = blob[pos:pos + key_len].decode(errors='replace')
+            pos += key_len
+            val_len, = PACKED_VALUE.unpack_from(blob, pos)
+            pos += PACKED_VALUE.size
+            if pos + val_len > end:
+                break
+            out[key] = blob[pos:pos + val_len]
+            pos += val_len
         return out
 
+    def packed_slot_name(self, index: int) -> str:
+        return PACKED_XATTR if index == 0 else f"{PACKED_XATTR}.{index}"
+
+    # a damaged length can claim any number of slots, so it is capped at the
+    # slots the file has (one listxattr, only for blobs spanning several)
+    def packed_slot_count(self, filepath: str, first_slot: bytes) -> int:
+        if len(first_slot) < PACKED_LENGTH.size:
+            return 1
+        total = PACKED_LENGTH.size + PACKED_LENGTH.unpack_from(first_slot)[0]
+        count = -(-total // self.packed_xattr_size())
+        if count <= 1:
+            return count
+        prefix = f"{PACKED_XATTR}."
+        stored = sum(1 for attr in os.listxattr(filepath)
+                     if attr == PACKED_XATTR or attr[len(prefix):].isdigit() and attr.startswith(prefix))
+        return min(count, stored)
+
+    # both ends must split blobs the same way, so the probed size is shared
+    def packed_xattr_size(self) -> int:
+        if self.packed_size is None:
+            setting = self.read_share_setting(PACKED_SIZE_SETTING)
+            if setting:
+                self.packed_size = int(setting)
+            else:
+                self.packed_size = self.probe_packed_size(self.config_file)
+                self.write_share_setting(PACKED_SIZE_SETTING, str(self.packed_size))
+            metrics.event('packed_xattr_size', size=self.packed_size, probed=not setting)
+        return self.packed_size
+
+    # largest value a single xattr takes, measured on a scratch key of the
+    # config file. its share settings take some of the room on ext4, which
+    # leaves a little headroom for the carriers
+    def probe_packed_size(self, file: str) -> int:
+        key = f"{PACKED_XATTR}.probe"
+
+        def accepted(size: int) -> bool:
+            try:
+                os.setxattr(file, key, b'x' * size)
+                return True
+            except OSError:
+                return False
+        try:
+            size = self.probe_limit(accepted, PACKED_MAX_SIZE)
+        finally:
+            try:
+                os.removexattr(file, key)
+            except OSError:
+                pass
+        if size < PACKED_LENGTH.size:
+            raise OSError(f"{self.root_path} does not support packed xattrs")
+        return size
+
+    def get_packed_slot(self, filepath: str, index: int) -> bytes | None:
+        try:
+            return os.getxattr(filepath, self.packed_slot_name(index))
+        except OSError:
+            return None
+
     # NOTE: its kind of expensive updates VFS everytime
     def read_signal(self) -> Signal:
-        super().read_signal()
-        # read signal from first byte of hash
-        file_data = self.read_content(self.sync_file)
-        sig_val = get_hash_byte(file_data)
+        return self.read_signal_arg()[0]
+
+    # the argument is stored in the hash bits above the signal byte
+    def read_signal_arg(self) -> tuple[Signal, int]:
+        super().read_signal_arg()
+        return self.parse_signal(self.read_content(self.sync_file))
+
+    # without the poll delay of read_signal_arg
+    def poll_signal(self) -> tuple[Signal, int]:
+        self.update_virtual_filesystem()
+        return self.parse_signal(self.read_content(self.sync_file))
+
+    def parse_signal(self, file_data: bytes) -> tuple[Signal, int]:
+        value = get_hash_bits(file_data, 8 + SIGNAL_ARG_BITS)
         try:
-            sig = Signal(sig_val)
+            sig = Signal(value % 256)
         except:
             sig = Signal.CLEAR
-        return sig
+        return sig, value >> 8
+
+    # sleeps on inotify events for the sync/config files instead of polling.
+    # events never fire for writes made by other NFS clients, so the wait
+    # still re-reads on a timeout that backs off while nothing changes
+    def wait_for_signal(self, *signals: Signal) -> tuple[Signal, int]:
+        wait = self.poll_schedule.wait()
+        last_data = None
+        while True:
+            self.update_virtual_filesystem()
+            # watch before reading so a change in between still wakes us up
+            if self.inotify:
+                self.inotify.watch([self.config_file, self.sync_file])
+            file_data = self.read_content(self.sync_file)
+            sig, arg = self.parse_signal(file_data)
+            if sig in signals:
+                return sig, arg
+            # reset the backoff whenever the sync file moved
+            if file_data != last_data:
+                wait.reset()
+            last_data = file_data
+            if not self.inotify:
+                wait.sleep()
+            elif self.inotify.wait(wait.next_period()):
+                wait.reset()
 
-    def set_signal(self, sig: Signal) -> None:
+    def set_signal(self, sig: Signal, arg: int = None, file: str = None) -> None:
         super().set_signal()
-        print(f"[SEND] {sig.name}")
+        metrics.event('signal_set', signal=sig.name, arg=arg)
+        self.poll_schedule.expect_reply()
+        file = file or self.sync_file
         # encode signal into hash
-        file_data = self.read_content(self.sync_file)
-        modified_data = set_hash_byte(file_data, sig.value)
-        self.write_content(self.sync_file, modified_data)
+        file_data = self.read_content(file)
+        if arg is None:
+            modified_data = set_hash_byte(file_data, sig.value)
+        else:
+            modified_data = set_hash_bits(file_data, sig.value | arg << 8, 8 + SIGNAL_ARG_BITS)
+        self.write_content(file, modified_data)
  
\ No newline at end of file
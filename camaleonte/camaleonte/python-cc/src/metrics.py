@@ -0,0 +1,121 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Hot path instrumentation. Counters and timing histograms are always kept
+# (they are cheap), events and snapshots go to a pluggable sink that drops
+# everything unless one is installed, e.g.
+#     metrics.set_sink(JsonSink("metrics.jsonl"))
+# client.py and server.py install one when this environment variable holds a path
+METRICS_ENV = "CAMALEONTE_METRICS"
+
+
+class Sink:
+    # default sink, does nothing
+    def emit(self, record: dict) -> None:
+        pass
+
+
+class JsonSink(Sink):
+    # writes one json object per line to a path or an open text stream
+    def __init__(self, target) -> None:
+        self.stream = open(target, "a") if isinstance(target, str) else target
+        self.lock = threading.Lock()
+
+    def emit(self, record: dict) -> None:
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+
+class Histogram:
+    # power of two buckets in microseconds, so a snapshot stays small
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        bucket = int(seconds * 1e6).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum_s": self.total,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "min_s": self.min if self.count else 0.0,
+            "max_s": self.max,
+            # upper bound of each bucket in microseconds -> observations
+            "buckets_us": {1 << b: n for b, n in sorted(self.buckets.items())},
+        }
+
+
+class Metrics:
+    def __init__(self, sink: Sink = None) -> None:
+        self.sink = sink or Sink()
+        self.counters = {}
+        self.histograms = {}
+        # protocol workers update these from several threads
+        self.lock = threading.Lock()
+
+    def set_sink(self, sink: Sink) -> None:
+        self.sink = sink or Sink()
+
+    @property
+    def enabled(self) -> bool:
+        return type(self.sink) is not Sink
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    # a structured replacement for the old debug prints
+    def event(self, name: str, **fields) -> None:
+        if self.enabled:
+            self.sink.emit({"event": name, "time": time.time(), **fields})
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {name: h.snapshot() for name, h in self.histograms.items()},
+            }
+
+    # sends the current counters and histograms to the sink
+    def flush(self) -> None:
+        if self.enabled:
+            self.sink.emit({"event": "metrics", "time": time.time(), **self.snapshot()})
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+# process wide instance used by the mediums, protocols and hash helpers
+metrics = Metrics()
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+from src.mediums.async_filesystem import AsyncFilesystem, SignalPoller
+from src.metrics import metrics
+from src.protocol.protocol import Protocol, SignalWait
+
+
+# drives the engine of a Protocol on an event loop, so one process can serve
+# many channels (one Protocol and Filesystem each) from the same SignalPoller:
+#     poller = SignalPoller()
+#     channels = [AsyncProtocol(HashProtocol(LinuxFileSystem(path)), poller) for _ in range(n)]
+#     for cc in channels:
+#         await cc.wait_for_connection()
+#     replies = await asyncio.gather(*(cc.read() for cc in channels))
+# the wire format is the one of the wrapped protocol, peers may run either engine
+class AsyncProtocol:
+    def __init__(self, protocol: Protocol, poller: SignalPoller = None) -> None:
+        self.protocol = protocol
+        self.filesystem = AsyncFilesystem(protocol.filesystem, poller)
+
+    ### INITIAL CONNECTION
+    async def connect(self) -> None:
+        await self.run_steps(self.protocol.connect_steps())
+
+    async def wait_for_connection(self) -> None:
+        current_count = await self.filesystem.get_client_count()
+        wait = self.protocol.filesystem.poll_schedule.wait()
+        while current_count == await self.filesystem.get_client_count():
+            await asyncio.sleep(wait.next_period())
+            await self.filesystem.run(wait.acquire)
+        await self.join_channel(current_count)
+
+    async def join_channel(self, pos: int, client: bool = False) -> None:
+        await self.run_steps(self.protocol.join_steps(pos, client))
+
+    # see Protocol.switch_steps
+    async def switch_layout(self) -> None:
+        await self.run_steps(self.protocol.switch_steps())
+
+    ### READ/WRITE
+    async def read(self) -> bytes:
+        start = time.perf_counter()
+        data = await self.run_steps(self.protocol.read_steps())
+        self.protocol.count_message('read', time.perf_counter() - start)
+        return data
+
+    async def write(self, data: bytes) -> None:
+        start = time.perf_counter()
+        await self.run_steps(self.protocol.write_steps(data))
+        self.protocol.count_message('write', time.perf_counter() - start)
+
+    # answers the steps of an engine, see SignalWait
+    async def run_steps(self, steps):
+        reply = None
+        while True:
+            try:
+                step = steps.send(reply)
+            except StopIteration as stop:
+                return stop.value
+            if isinstance(step, SignalWait):
+                with metrics.timer('signal_wait'):
+                    reply = await self.filesystem.wait_for_signal(*step.signals)
+            else:
+                reply = await self.filesystem.run(step)
@@ -1,25 +1,39 @@
 from src.mediums.filesystem import HashEncoding
 from .protocol import Protocol
 
-from src.utils import get_hash_byte, set_hash_byte
+from src.utils import get_hash_bits, set_hash_bits
+
+
+# every byte per file mines 8 more bits of the crc32
+MAX_BYTES_PER_FILE = 4
 
 
 class HashProtocol(Protocol):
-    def __init__(self, filesystem: HashEncoding):
-        self.filesystem = filesystem
+    def __init__(self, filesystem: HashEncoding, bytes_per_file: int = 1, **options):
+        super().__init__(filesystem, **options)
+        # 1 is the original carrier the ruby port speaks
+        if not 1 <= bytes_per_file <= MAX_BYTES_PER_FILE:
+            raise ValueError(f"Bytes per file must be between 1 and {MAX_BYTES_PER_FILE}!")
+        self.bytes_per_file = bytes_per_file
+        # the whole share minus the config and sync files, join_steps checks the slice
+        self.check_files(len(filesystem.get_all_files()) - 2)
 
     def encode_file(self, filepath: str, data: bytes) -> None:
         filedata = self.filesystem.read_content(filepath)
+        # the last chunk of a batch can be short, pad it with zeros
+        desired = int.from_bytes(data.ljust(self.bytes_per_file, b'\x00'), 'little')
+        # nothing to mine or write when the file already carries the value
+        if get_hash_bits(filedata, 8 * self.bytes_per_file) == desired:
+            return
         # mine until desired hash
-        filedata = set_hash_byte(filedata, ord(data))
+        filedata = set_hash_bits(filedata, desired, 8 * self.bytes_per_file)
         # update the file
         self.filesystem.write_content(filepath, filedata)
 
     def decode_file(self, filepath: str) -> bytes:
         filedata = self.filesystem.read_content(filepath)
-        received_byte = get_hash_byte(filedata)
-        # return as a 'bytes' type
-        return chr(received_byte).encode()
+        received = get_hash_bits(filedata, 8 * self.bytes_per_file)
+        return received.to_bytes(self.bytes_per_file, 'little')
     
     def data_per_file(self):
-        return 1
\ No newline at end of file
+        return self.bytes_per_file
@@ -1,50 +1,98 @@
 import base64
+import binascii
+from typing import Iterable
 
 from src.mediums.filesystem import MetadataEncoding
 from .protocol import Protocol
 
-from src.utils import TERMINATOR
-
 
 class MetadataProtocol(Protocol):
-    def __init__(self, filesystem: MetadataEncoding):
-        self.filesystem = filesystem
+    def __init__(self, filesystem: MetadataEncoding, **options):
+        super().__init__(filesystem, **options)
+        # every peer picks up the layout a tune_properties() stored with the share
+        filesystem.load_properties()
+        # framed batches are binary safe, so skip base64 where the medium stores bytes
+        self.raw_properties = self.framing and filesystem.BINARY_PROPERTIES
+        # the whole share minus the config and sync files, join_steps checks the slice
+        self.check_files(len(filesystem.get_all_files()) - 2)
 
     # TODO: make this 
     # TODO: to be more covert preserve existing metadata fields if they exist
     # TODO: dont name the fields covert_data_x (too obvious)
     def encode_file(self, file: str, data: bytes) -> None:
+        # update the filesystem
+        self.filesystem.write_properties(file, self.encode_properties(data))
+
+    def decode_file(self, file: str) -> bytes:
+        if self.raw_properties:
+            properties = self.filesystem.read_properties(file, raw=True)
+        else:
+            properties = self.filesystem.read_properties(file)
+        return self.decode_properties(properties)
+
+    # one bulk request per batch when the medium supports it
+    def encode_files(self, files: list[str], chunks: list[bytes]) -> None:
+        if not self.filesystem.BATCH_IO:
+            return super().encode_files(files, chunks)
+        props_map = {}
+        for file, chunk in zip(files, chunks):
+            properties = self.encode_properties(chunk)
+            # null out unused keys instead of reading the old ones first
+            for i in range(len(properties), self.filesystem.PROPERTY_COUNT):
+                properties[f'hash_{i}'] = None
+            props_map[file] = properties
+        self.filesystem.write_properties_batch(props_map)
+
+    def decode_files(self, files: list[str]) -> Iterable[bytes]:
+        if not self.filesystem.BATCH_IO:
+            return super().decode_files(files)
+        props_map = self.filesystem.read_properties_batch(files)
+        return [self.decode_properties(props_map.get(file, {})) for file in files]
+
+    def encode_properties(self, data: bytes) -> dict:
         # split up into chunks for each property
+        property_size = self.property_size()
         property_chunks = [
-            data[i:i+self.filesystem.PROPERTY_SIZE]
-            for i in range(0, len(data), self.filesystem.PROPERTY_SIZE)
+            data[i:i+property_size]
+            for i in range(0, len(data), property_size)
         ]
         # set each property
         properties = {}
         for i, chunk in enumerate(property_chunks):
             prop_index = i
-            properties[f'hash_{prop_index}'] = base64.b64encode(
-                chunk).decode('utf-8')
-        # update the filesystem
-        self.filesystem.write_properties(file, properties)
+            if self.raw_properties:
+                properties[f'hash_{prop_index}'] = chunk
+            else:
+                properties[f'hash_{prop_index}'] = base64.b64encode(
+                    chunk).decode('utf-8')
+        return properties
 
-    def decode_file(self, file: str) -> bytes:
+    def decode_properties(self, properties: dict) -> bytes:
         decoded = b''
-        properties = self.filesystem.read_properties(file)
         # read data from properties of file
         for i in range(self.filesystem.PROPERTY_COUNT):
             key = f'hash_{i}'
             # if property doesnt exist... break
             if key not in properties:
                 break
-            cur_chunk = base64.b64decode(
-                properties[key].encode('utf-8')
-            )
+            if self.raw_properties:
+                cur_chunk = properties[key]
+            else:
+                try:
+                    cur_chunk = base64.b64decode(
+                        properties[key].encode('utf-8')
+                    )
+                except binascii.Error:
+                    # tampered with, the batch checksum rejects the short chunk
+                    break
             decoded += cur_chunk
-            # if current chunk is the last one
-            if TERMINATOR in cur_chunk:
-                break
         return decoded
 
+    # raw properties fill the space base64 would have taken
+    def property_size(self) -> int:
+        if self.raw_properties:
+            return 4 * -(-self.filesystem.PROPERTY_SIZE // 3)
+        return self.filesystem.PROPERTY_SIZE
+
     def data_per_file(self):
-        return self.filesystem.PROPERTY_SIZE * self.filesystem.PROPERTY_COUNT
+        return self.property_size() * self.filesystem.PROPERTY_COUNT
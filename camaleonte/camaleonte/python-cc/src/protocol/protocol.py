@@ -1,80 +1,321 @@
+import struct
 import time
+import zlib
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
 
-from src.mediums.filesystem import Filesystem, Signal
-from src.utils import TERMINATOR, CHECKSUM_HASH_SIZE, checksum_hash
+from src.fec import encode_parity, recover
+from src.mediums.filesystem import Filesystem, Signal, SIGNAL_ARG_BITS, layout_level
+from src.metrics import metrics
+from src.utils import TERMINATOR, CHECKSUM_HASH_SIZE, CODEC_RAW, checksum_hash, compress_payload, decompress_payload
 
 
-CONNECTION_POLL_DELAY = .1
+# windowed batches carry a one byte sequence number after the checksum
+SEQUENCE_SIZE = 1
+SEQUENCE_SPACE = 256
+# ack masks are sent as the signal argument, one bit per file group
+MAX_WINDOW = SIGNAL_ARG_BITS
 
-# TODO: add method to pause and recalculate batches when new client joins (VFS change)
+# framed batches are binary safe: crc32 | sequence | length of the data,
+# the top length bit marks the last batch of a message so no terminator is needed
+FRAME_CHECKSUM_SIZE = 4
+FRAME_FIELDS = struct.Struct('<HI')
+FRAME_HEADER_SIZE = FRAME_CHECKSUM_SIZE + FRAME_FIELDS.size
+FRAME_SEQUENCE_SPACE = 1 << 16
+FRAME_FINAL = 1 << 31
+# the next two bits hold the payload codec, see compress_payload()
+FRAME_CODEC_SHIFT = 29
+FRAME_LENGTH_MASK = (1 << FRAME_CODEC_SHIFT) - 1
+
+# framed batches may be split into tagged segments, so a damaged carrier only
+# costs a rewrite of its own segment. every segment ends with a short crc of
+# its bytes keyed by the frame checksum, and ack masks get one bit per segment
+SEGMENT_TAG_SIZE = 2
+SEGMENT_KEY = struct.Struct('<IB')
+# parity segments start with the checksum and size of the frame they protect,
+# so they can stand in for a damaged first segment
+PARITY_FIELDS = struct.Struct('<II')
+
+# with epochs the top bits of a DONE argument hold log2 of the layout level the
+# batches were written with, leaving the rest for the mask
+EPOCH_SHIFT = SIGNAL_ARG_BITS - 4
+EPOCH_MASK = (1 << EPOCH_SHIFT) - 1
+# the highest level such a tag holds
+MAX_EPOCH_LEVEL = 1 << (1 << SIGNAL_ARG_BITS - EPOCH_SHIFT) - 1
+
+
+# the read/write engines are generators of steps, so the same logic runs
+# blocking (Protocol.run_steps) or on an event loop (see AsyncProtocol). a
+# SignalWait is answered with the (signal, arg) that showed up, any other step
+# is a call doing medium I/O and is answered with its result
+class SignalWait:
+    def __init__(self, *signals: Signal) -> None:
+        self.signals = signals
+
+# EPOCHS: by default a client joining repartitions every channel on the spot
+# and clears its sync file, which throws away whatever was in flight. with
+# epochs the files are split in nested slices (see Filesystem.slot_files) and
+# a channel keeps its layout until its writer has every batch so far
+# acknowledged. the writer then moves to the new level and tags its DONEs with
+# it, the reader follows the tag, and once the reader answered the writer
+# releases the tails to the channels that joined. those wait for the release
+# before touching their files (see join_steps). idle channels are moved by
+# switch_steps(), the session manager runs it when the layout grows.
+# both ends must enable it, the ruby port does not speak it
 class Protocol(ABC):
-    def __init__(self, filesystem: Filesystem) -> None:
+    def __init__(self, filesystem: Filesystem, window: int = 1, framing: bool = False,
+                 compression: bool = False, workers: int = 1, delta_writes: bool = True,
+                 segments: int = 1, parity: int = 0, epochs: bool = False) -> None:
         self.filesystem = filesystem
+        # number of batches kept in flight, 1 is the original stop-and-wait
+        if not 1 <= window <= MAX_WINDOW:
+            raise ValueError(f"Window must be between 1 and {MAX_WINDOW}!")
+        self.window = window
+        # length prefixed binary batches, off by default to stay compatible
+        # with the terminator format spoken by the ruby port
+        self.framing = framing
+        # compress outgoing messages, the codec travels in the frame header so
+        # readers decompress whatever they receive regardless of this setting
+        if compression and not framing:
+            raise ValueError("Compression requires framing!")
+        self.compression = compression
+        # tagged segments per file group, 1 keeps whole batch retransmission
+        if segments > 1 and not framing:
+            raise ValueError("Segments require framing!")
+        if not 1 <= segments * window <= MAX_WINDOW:
+            raise ValueError(f"Window times segments must be between 1 and {MAX_WINDOW}!")
+        self.segments = segments
+        self.epochs = epochs
+        filesystem.epochs = epochs
+        if epochs and segments * window > EPOCH_SHIFT:
+            raise ValueError(f"Window times segments must be at most {EPOCH_SHIFT} with epochs!")
+        # the last `parity` segments of every group carry forward error
+        # correction, so that many damaged segments are repaired by the reader
+        if not 0 <= parity < segments:
+            raise ValueError("Parity must leave at least one data segment!")
+        self.parity = parity
+        # per file encode/decode calls are independent, so they can be fanned
+        # out over a thread pool to overlap nfs / drive round trips
+        if workers < 1:
+            raise ValueError("Workers must be at least 1!")
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        # (raw, wire, codec) sizes of the last message, see count_payload()
+        self.last_payload = (0, 0, CODEC_RAW)
+        # last value written to or read from each carrier file, files that
+        # already hold their chunk are not rewritten (see write_batch)
+        self.delta_writes = delta_writes
+        self.file_values = {}
+        self.file_values_version = None
+        # layout level -> whether the slices at that level fit these options
+        self.fitting_levels = {}
 
 
     ### INITIAL CONNECTION
     def connect(self):
+        self.run_steps(self.connect_steps())
+
+    def connect_steps(self):
         # increment client count
-        current_count = self.filesystem.get_client_count()
-        self.filesystem.set_client_count(current_count+1)
+        current_count = yield self.filesystem.get_client_count
+        # refuse before taking a channel, a raised count moves the channels
+        # already running to the smaller slices
+        yield lambda: self.check_level(layout_level(current_count + 1))
+        yield lambda: self.filesystem.set_client_count(current_count+1)
         # set channel pos to index
-        self.filesystem.set_channel_pos(current_count)
-        # update vfs + clear sync
-        self.filesystem.update_virtual_filesystem()
-        self.filesystem.set_signal(Signal.CLEAR)
+        yield from self.join_steps(current_count, client=True)
 
 
     def wait_for_connection(self):
         # wait for count to be incremented
         current_count = self.filesystem.get_client_count()
+        # backs off like an idle signal wait
+        wait = self.filesystem.poll_schedule.wait()
         while current_count == self.filesystem.get_client_count():
-            time.sleep(CONNECTION_POLL_DELAY)
+            wait.sleep()
+        self.join_channel(current_count)
+
+    def join_channel(self, pos: int, client: bool = False) -> None:
+        self.run_steps(self.join_steps(pos, client))
+
+    def join_steps(self, pos: int, client: bool = False):
         # set the channel pos
-        self.filesystem.set_channel_pos(current_count)
-        # update vfs + clear sync
-        self.filesystem.update_virtual_filesystem()
-        self.filesystem.set_signal(Signal.CLEAR)
+        yield lambda: self.filesystem.set_channel_pos(pos)
+        if not self.epochs:
+            # update vfs + clear sync
+            yield self.filesystem.update_virtual_filesystem
+            yield self.check_layout
+            yield lambda: self.filesystem.set_signal(Signal.CLEAR)
+            return
+        yield self.filesystem.update_virtual_filesystem
+        level = self.filesystem.pending_level
+        yield lambda: self.filesystem.set_layout(level)
+        yield self.check_layout
+        if client:
+            if pos:
+                # until released these files carry batches of the channel that
+                # had them. later joins may have it released at a higher level,
+                # the sync file is the same on every level the channel is in
+                released = yield from self.wait_for_arg(Signal.RELEASED, lambda arg: self.valid_level(pos, arg))
+                level = max(level, released)
+        else:
+            # the client announces the level it laid out with once its files are free
+            level = yield from self.wait_for_arg(Signal.CLEAR, lambda arg: self.valid_level(pos, arg))
+        if level != self.filesystem.layout_level:
+            yield lambda: self.filesystem.set_layout(level)
+            yield self.check_layout
+        if client:
+            yield lambda: self.filesystem.set_signal(Signal.CLEAR, level)
+
+    # a layout level `pos` has a slot in, anything else is a carrier that
+    # only looks like a signal
+    def valid_level(self, pos: int, level: int) -> bool:
+        return pos < level <= MAX_EPOCH_LEVEL and level & (level - 1) == 0
+
+    # waits for `sig` with an argument `accept` takes, returns the argument
+    def wait_for_arg(self, sig: Signal, accept):
+        while True:
+            _, arg = yield SignalWait(sig)
+            if accept(arg):
+                return arg
+            yield lambda: time.sleep(self.filesystem.MAX_POLL_PERIOD)
+
+    # fewest data files a channel needs for a header and some data per group
+    def min_channel_files(self) -> int:
+        per_file = self.data_per_file()
+        if not (self.window > 1 or self.framing or self.epochs):
+            return -(-(CHECKSUM_HASH_SIZE + 1) // per_file)
+        # the first segment holds the whole header, a lone data segment some data too
+        needed = self.header_size() + (1 if self.segments - self.parity == 1 else 0)
+        if self.segments > 1:
+            needed += SEGMENT_TAG_SIZE + (PARITY_FIELDS.size if self.parity else 0)
+        return -(-needed // per_file) * self.segments * self.window
+
+    def check_files(self, count: int) -> None:
+        minimum = self.min_channel_files()
+        if count < minimum:
+            raise ValueError(f"These options need at least {minimum} files per channel, got {count}!")
+
+    # the slice of this channel, without its sync file
+    def check_layout(self) -> None:
+        self.check_files(len(self.filesystem.virtual_filesystem) - 1)
+
+    # the smallest slice when the share is split in `level` slices
+    def check_level(self, level: int) -> None:
+        self.check_files((len(self.filesystem.get_all_files()) - 1) // level - 1)
+
+    # whether this channel may move to `level`, remembered per level since
+    # the share is listed to find out. a refused switch leaves the channel
+    # on its current layout
+    def level_fits(self, level: int) -> bool:
+        if level not in self.fitting_levels:
+            try:
+                self.check_level(level)
+                self.fitting_levels[level] = True
+            except ValueError as e:
+                metrics.event('layout_refused', level=level, error=str(e))
+                self.fitting_levels[level] = False
+        return self.fitting_levels[level]
+
+    ### EPOCHS
+    def switch_pending(self) -> bool:
+        level = self.filesystem.pending_level
+        return self.epochs and level > self.filesystem.layout_level and self.level_fits(level)
+
+    # moves an idle channel to the level the client count asks for
+    def switch_layout(self) -> None:
+        self.run_steps(self.switch_steps())
+
+    def switch_steps(self):
+        if not self.epochs:
+            return
+        yield SignalWait(Signal.CLEAR)
+        # read right away, the config stamp may not have caught up yet
+        count = yield self.filesystem.get_client_count
+        level = max(layout_level(count), self.filesystem.pending_level)
+        released = self.filesystem.layout_level
+        if level <= released or not self.level_fits(level):
+            return
+        yield lambda: self.filesystem.set_layout(level)
+        # a DONE without batches, the reader takes the tag and answers
+        yield lambda: self.filesystem.set_signal(Signal.DONE, self.done_arg(0))
+        yield SignalWait(Signal.ACK, Signal.NACK)
+        yield lambda: self.filesystem.release_slots(released)
+        yield lambda: self.filesystem.set_signal(Signal.CLEAR)
+
+    def done_arg(self, sent_mask: int) -> int:
+        if not self.epochs:
+            return sent_mask
+        return sent_mask | (self.filesystem.layout_level.bit_length() - 1) << EPOCH_SHIFT
 
     ### READ/WRITE
     def read(self) -> bytes:
+        start = time.perf_counter()
+        data = self.run_steps(self.read_steps())
+        self.count_message('read', time.perf_counter() - start)
+        return data
+
+    def write(self, data: bytes) -> None:
+        start = time.perf_counter()
+        self.run_steps(self.write_steps(data))
+        self.count_message('write', time.perf_counter() - start)
+
+    def read_steps(self):
+        if self.window > 1 or self.framing or self.epochs:
+            return self.read_windowed()
+        return self.read_stop_and_wait()
+
+    def write_steps(self, data: bytes):
+        if self.window > 1 or self.framing or self.epochs:
+            return self.write_windowed(data)
+        return self.write_stop_and_wait(data)
+
+    # answers the steps of an engine in this thread, see SignalWait
+    def run_steps(self, steps):
+        reply = None
+        while True:
+            try:
+                step = steps.send(reply)
+            except StopIteration as stop:
+                return stop.value
+            if isinstance(step, SignalWait):
+                reply = self.wait_for_signal(*step.signals)
+            else:
+                reply = step()
+
+    # the original one batch at a time format, spoken by the ruby port
+    def read_stop_and_wait(self):
         data = b''
         # keep on reading until terminator found
         while True:
             # wait for a done signal
-            while self.filesystem.read_signal() != Signal.DONE:
-                pass
-            print("[READ] DONE")
+            yield SignalWait(Signal.DONE)
             # read the current batch
-            current_batch = b''
-            for file in self.filesystem.get_files():
-                current_batch += self.decode_file(file)
-                if TERMINATOR in current_batch:
-                    break
-            print("RECEIVED BATCH:", len(current_batch))
-            print(current_batch)
+            current_batch = yield lambda: self.read_batch(self.filesystem.get_files(), 0)
             # verify the batch
             received_hash = current_batch[0:CHECKSUM_HASH_SIZE]
             calculated_hash = checksum_hash(current_batch[CHECKSUM_HASH_SIZE:])
+            metrics.event('batch_received', size=len(current_batch), ok=received_hash == calculated_hash)
             # if the hash is correct
             if received_hash == calculated_hash:
                 data += current_batch[CHECKSUM_HASH_SIZE:]
-                self.filesystem.set_signal(Signal.ACK)
+                yield lambda: self.filesystem.set_signal(Signal.ACK)
             else:
-                self.filesystem.set_signal(Signal.NACK)
+                yield lambda: self.filesystem.set_signal(Signal.NACK)
             # check if we are done reading
             if TERMINATOR in data:
                 data = data.split(TERMINATOR)[0]
                 break
+        self.count_payload(len(data), len(data) + len(TERMINATOR), CODEC_RAW)
         return data
 
-    def write(self, data: bytes) -> None:
+    def write_stop_and_wait(self, data: bytes):
         # ensure that signal is cleared
-        while self.filesystem.read_signal() != Signal.CLEAR:
-            pass
+        yield SignalWait(Signal.CLEAR)
         # split up into "batches" or "packets"
         payload = data + TERMINATOR
-        files = self.filesystem.get_files()
+        self.count_payload(len(data), len(payload), CODEC_RAW)
+        files = yield self.filesystem.get_files
         total_files = len(files)
         # find if valid file count and amnt of data per batch
         DATA_PER_BATCH = self.data_per_file() * total_files - CHECKSUM_HASH_SIZE
@@ -89,31 +330,492 @@ class Protocol(ABC):
         while cur_batch_i < len(batches):
             # add the checksum to beginning
             batch = batches[cur_batch_i]
-            print("Sent Hash:", checksum_hash(batch))
             batch = checksum_hash(batch) + batch
-            # split up the batch into file sized chunks
-            file_chunks = []
-            for i in range(0, len(batch), self.data_per_file()):
-                file_chunks.append(batch[i:i+self.data_per_file()])
-            # write each file chunk
-            for i, chunk in enumerate(file_chunks):
-                self.encode_file(files[i], chunk)
+            start = time.perf_counter()
+            yield lambda: self.write_batch(files, batch)
             # tell receiver that we are done writing batch
-            print("SENT BATCH:", len(batch))
-            print(batch)
-            self.filesystem.set_signal(Signal.DONE) 
+            metrics.event('batch_sent', index=cur_batch_i, size=len(batch))
+            yield lambda: self.filesystem.set_signal(Signal.DONE)
             # wait for ACK or NACK
-            while True:
-                sig = self.filesystem.read_signal()
-                if sig == Signal.ACK:
-                    print("[READ] ACK")
-                    cur_batch_i += 1
+            sig, _ = yield SignalWait(Signal.ACK, Signal.NACK)
+            self.count_round_trip(start, 1, 0 if sig == Signal.ACK else 1)
+            if sig == Signal.ACK:
+                cur_batch_i += 1
+            else:
+                self.forget_file_values(files)
+        # done writing all batches
+        yield lambda: self.filesystem.set_signal(Signal.CLEAR)
+
+    ### WINDOWED READ/WRITE
+    # the vfs is split into `window` file groups, each carrying its own
+    # sequenced batch. one DONE publishes every group in flight and the
+    # reader answers with a mask of the groups it accepted, so only the
+    # rejected groups are resent while freed groups take the next batches.
+    # framed messages always go through here, with a window of 1 it is
+    # plain stop-and-wait
+    def read_windowed(self):
+        sequence_space = self.sequence_space()
+        all_segments = (1 << self.segments) - 1
+        # verified segments of groups that are not complete yet
+        partial = {}
+        groups = None
+        groups_version = None
+        received = {}
+        next_index = 0
+        chunks = []
+        codec = CODEC_RAW
+        done = False
+        while not done:
+            sig, sent_mask = yield SignalWait(Signal.DONE)
+            if self.epochs:
+                level = 1 << (sent_mask >> EPOCH_SHIFT)
+                sent_mask &= EPOCH_MASK
+                if level != self.filesystem.layout_level:
+                    # the writer switched layouts at this batch boundary
+                    yield lambda: self.filesystem.set_layout(level)
+            if groups is None or self.epochs and groups_version != self.filesystem.vfs_version:
+                # taken once the writer started, clients may join while we wait
+                groups = yield self.file_groups
+                groups_version = self.filesystem.vfs_version
+            accepted_mask = 0
+            expected_mask = 0
+            for g, group in enumerate(groups):
+                sent = sent_mask >> g * self.segments & all_segments
+                if not sent:
+                    continue
+                expected_mask |= all_segments << g * self.segments
+                if self.segments > 1:
+                    frame, held = yield lambda: self.read_segments(group, sent, partial.setdefault(g, {}))
+                    accepted_mask |= held << g * self.segments
+                    if frame is None:
+                        continue
+                    batch = self.unpack_batch(frame)
+                    del partial[g]
+                else:
+                    batch = self.unpack_batch((yield lambda: self.read_group(group)))
+                if batch is None:
+                    # every tag matched but the frame did not, start over
+                    accepted_mask &= ~(all_segments << g * self.segments)
+                    continue
+                accepted_mask |= all_segments << g * self.segments
+                # map the wrapped sequence number back onto a batch index
+                seq = batch[0]
+                index = next_index + (seq - next_index) % sequence_space
+                received[index] = batch[1:]
+            # deliver batches in order
+            while not done and next_index in received:
+                body, done, codec = received.pop(next_index)
+                chunks.append(body)
+                next_index += 1
+            metrics.event('window_received', sent_mask=sent_mask, accepted_mask=accepted_mask)
+            sig = Signal.ACK if accepted_mask & expected_mask == expected_mask else Signal.NACK
+            yield lambda: self.filesystem.set_signal(sig, accepted_mask)
+        payload = b''.join(chunks)
+        if not self.framing:
+            # the last batch may hold leftovers past the terminator
+            payload = payload.split(TERMINATOR)[0] + TERMINATOR
+            data = payload[:-len(TERMINATOR)]
+        else:
+            data = yield lambda: decompress_payload(codec, payload)
+        self.count_payload(len(data), len(payload), codec)
+        return data
+
+    def write_windowed(self, data: bytes):
+        yield SignalWait(Signal.CLEAR)
+        codec, payload = CODEC_RAW, data
+        if self.compression:
+            codec, payload = yield lambda: compress_payload(data)
+        elif not self.framing:
+            payload = data + TERMINATOR
+        self.count_payload(len(data), len(payload), codec)
+        groups = yield self.file_groups
+        batches = self.split_batches(payload, groups)
+        sequence_space = self.sequence_space()
+        all_segments = (1 << self.segments) - 1
+        parity_segments = all_segments & ~((1 << self.segments - self.parity) - 1)
+        in_flight = {}  # group -> batch index
+        pending = {}  # group -> mask of segments to (re)write
+        acked = set()
+        oldest = 0
+        next_batch = 0
+        # layout level whose tails are released once the reader answered
+        released = 0
+        while oldest < len(batches):
+            if self.switch_pending() and not in_flight:
+                # every batch so far is acknowledged, the rest goes out on the new layout
+                released = self.filesystem.layout_level
+                yield lambda: self.filesystem.set_layout(self.filesystem.pending_level)
+                groups = yield self.file_groups
+                sent = sum(len(batch) for batch in batches[:next_batch])
+                batches = batches[:next_batch] + self.split_batches(payload[sent:], groups)
+            # fill free groups, never letting sequence numbers become ambiguous
+            for g in range(len(groups)):
+                if g in in_flight or next_batch == len(batches):
+                    continue
+                # drain the window before switching layouts
+                if self.switch_pending():
                     break
-                if sig == Signal.NACK:
-                    print("[READ] NACK")
+                if next_batch - oldest >= sequence_space // 2:
                     break
-        # done writing all batches
-        self.filesystem.set_signal(Signal.CLEAR)
+                in_flight[g] = next_batch
+                pending[g] = all_segments
+                next_batch += 1
+            # (re)write every group that is not acknowledged yet
+            start = time.perf_counter()
+            sent_mask = 0
+            for g, index in in_flight.items():
+                batch = self.pack_batch(index, batches[index], index == len(batches) - 1, codec)
+                if self.segments > 1:
+                    yield lambda: self.write_segments(groups[g], batch, pending[g])
+                else:
+                    yield lambda: self.write_batch(groups[g], batch)
+                sent_mask |= pending[g] << g * self.segments
+            metrics.event('window_sent', batches=sorted(in_flight.values()), sent_mask=sent_mask)
+            yield lambda: self.filesystem.set_signal(Signal.DONE, self.done_arg(sent_mask))
+            sig, accepted_mask = yield SignalWait(Signal.ACK, Signal.NACK)
+            if released:
+                # the reader is on the new layout too, nobody writes the tails anymore
+                yield lambda: self.filesystem.release_slots(released)
+                released = 0
+            sent_batches, rejected = len(in_flight), 0
+            for g, index in list(in_flight.items()):
+                accepted = accepted_mask >> g * self.segments & all_segments
+                if accepted == all_segments:
+                    acked.add(in_flight.pop(g))
+                    continue
+                rejected += 1
+                # only rewrite the rejected segments that carry part of the batch
+                used = (1 << self.segment_count(groups[g], len(batches[index]) + self.header_size())) - 1
+                used |= parity_segments
+                pending[g] = all_segments & ~accepted & used or used
+                metrics.count('segments_resent', bin(pending[g]).count('1'))
+                for s, files in enumerate(self.segment_files(groups[g])):
+                    if pending[g] >> s & 1:
+                        self.forget_file_values(files)
+            self.count_round_trip(start, sent_batches, rejected)
+            while oldest in acked:
+                oldest += 1
+        yield lambda: self.filesystem.set_signal(Signal.CLEAR)
+
+    # cuts a windowed payload into batches that fit the groups
+    def split_batches(self, payload: bytes, groups: list[list[str]]) -> list[bytes]:
+        data_per_batch = self.segment_capacity(groups[0]) * (self.segments - self.parity) - self.header_size()
+        if data_per_batch <= 0 or self.segment_capacity(groups[0]) < self.header_size():
+            raise Exception("NOT ENOUGH FILES")
+        # an empty framed message is still one (final) batch
+        return [
+            payload[i:i + data_per_batch]
+            for i in range(0, len(payload), data_per_batch)
+        ] or [b'']
+
+    ### BATCH FORMATS
+    # legacy: checksum_hash | seq byte | data, the message ends at the terminator
+    # framed: crc32 | seq | length (+ final bit and codec) | data
+    def header_size(self) -> int:
+        return FRAME_HEADER_SIZE if self.framing else CHECKSUM_HASH_SIZE + SEQUENCE_SIZE
+
+    def sequence_space(self) -> int:
+        return FRAME_SEQUENCE_SPACE if self.framing else SEQUENCE_SPACE
+
+    def pack_batch(self, index: int, data: bytes, final: bool, codec: int = CODEC_RAW) -> bytes:
+        seq = index % self.sequence_space()
+        if not self.framing:
+            batch = seq.to_bytes(SEQUENCE_SIZE, 'little') + data
+            return checksum_hash(batch) + batch
+        length = len(data) | codec << FRAME_CODEC_SHIFT | (FRAME_FINAL if final else 0)
+        batch = FRAME_FIELDS.pack(seq, length) + data
+        return zlib.crc32(batch).to_bytes(FRAME_CHECKSUM_SIZE, 'little') + batch
+
+    # returns (seq, data, final, codec) or None when the batch is corrupt
+    def unpack_batch(self, batch: bytes):
+        if len(batch) < self.header_size():
+            return None
+        if not self.framing:
+            if batch[:CHECKSUM_HASH_SIZE] != checksum_hash(batch[CHECKSUM_HASH_SIZE:]):
+                return None
+            data = batch[self.header_size():]
+            return batch[CHECKSUM_HASH_SIZE], data, TERMINATOR in data, CODEC_RAW
+        checksum = int.from_bytes(batch[:FRAME_CHECKSUM_SIZE], 'little')
+        if checksum != zlib.crc32(batch[FRAME_CHECKSUM_SIZE:]):
+            return None
+        seq, length = FRAME_FIELDS.unpack_from(batch, FRAME_CHECKSUM_SIZE)
+        codec = (length & ~FRAME_FINAL) >> FRAME_CODEC_SHIFT
+        return seq, batch[FRAME_HEADER_SIZE:], bool(length & FRAME_FINAL), codec
+
+    def read_group(self, files: list[str]) -> bytes:
+        if self.framing:
+            return self.read_frame(files)
+        return self.read_batch(files, self.header_size())
+
+    # size of a framed batch from its header
+    def frame_size(self, header: bytes) -> int:
+        length = FRAME_FIELDS.unpack_from(header, FRAME_CHECKSUM_SIZE)[1]
+        return FRAME_HEADER_SIZE + (length & FRAME_LENGTH_MASK)
+
+    ### SEGMENTS
+    # a group of n files is cut into `segments` runs of n // segments files.
+    # each holds a slice of the frame followed by its tag. the sender marks
+    # the segments it (re)wrote in the DONE mask, the reader keeps verified
+    # segments until the frame is complete and answers with the segments it
+    # holds, so only damaged carriers are encoded and read again. with parity
+    # the last `parity` segments carry a reed-solomon code of the others
+    # (prefixed with the frame checksum and size), and the reader rebuilds up
+    # to that many damaged segments without a round trip
+    def segment_files(self, files: list[str]) -> list[list[str]]:
+        size = len(files) // self.segments
+        return [files[s * size:(s + 1) * size] for s in range(self.segments)]
+
+    # frame bytes carried per data segment
+    def segment_capacity(self, files: list[str]) -> int:
+        if self.segments == 1:
+            return self.data_per_file() * len(files)
+        capacity = self.data_per_file() * (len(files) // self.segments) - SEGMENT_TAG_SIZE
+        return capacity - PARITY_FIELDS.size if self.parity else capacity
+
+    def segment_count(self, files: list[str], frame_size: int) -> int:
+        return min(-(-frame_size // self.segment_capacity(files)), self.segments - self.parity)
+
+    # keyed by the frame checksum so segments left over from another batch
+    # never match. the key is hashed as data, as a crc32 start value it would
+    # cancel out the checksum bytes at the start of the first segment
+    def segment_tag(self, index: int, payload: bytes, key: int) -> bytes:
+        seed = zlib.crc32(SEGMENT_KEY.pack(key, index))
+        tag = zlib.crc32(payload, seed) & ((1 << 8 * SEGMENT_TAG_SIZE) - 1)
+        return tag.to_bytes(SEGMENT_TAG_SIZE, 'little')
+
+    # segment index -> payload and tag, parity segments come last
+    def split_segments(self, files: list[str], frame: bytes) -> dict[int, bytes]:
+        capacity = self.segment_capacity(files)
+        key = int.from_bytes(frame[:FRAME_CHECKSUM_SIZE], 'little')
+        payloads = [frame[i:i + capacity] for i in range(0, len(frame), capacity)]
+        segments = dict(enumerate(payloads))
+        if self.parity:
+            prefix = PARITY_FIELDS.pack(key, len(frame))
+            for row, parity in enumerate(encode_parity(payloads, self.parity)):
+                segments[self.segments - self.parity + row] = prefix + parity
+        return {s: payload + self.segment_tag(s, payload, key) for s, payload in segments.items()}
+
+    # writes the segments of a frame picked by `mask` as one batch
+    def write_segments(self, files: list[str], frame: bytes, mask: int) -> None:
+        segment_files = self.segment_files(files)
+        picked_files, picked_chunks = [], []
+        for s, segment in self.split_segments(files, frame).items():
+            if mask >> s & 1:
+                chunks = self.split_chunks(segment)
+                picked_files += segment_files[s][:len(chunks)]
+                picked_chunks += chunks
+        self.write_chunks(picked_files, picked_chunks)
+
+    # returns the frame once every segment it spans checks out or was
+    # rebuilt (None before that) and the mask of segments the reader holds
+    # or does not need. `stored` keeps verified payloads across rounds,
+    # segments that were rewritten are dropped from it and read again
+    def read_segments(self, files: list[str], sent: int, stored: dict[int, bytes]) -> tuple[bytes, int]:
+        all_segments = (1 << self.segments) - 1
+        first_parity = self.segments - self.parity
+        for s in range(self.segments):
+            if sent >> s & 1:
+                stored.pop(s, None)
+        segment_files = self.segment_files(files)
+        capacity = self.segment_capacity(files)
+        if 0 not in stored:
+            segment = self.read_segment(segment_files[0], FRAME_HEADER_SIZE,
+                                        lambda header: min(capacity, self.frame_size(header)))
+            payload = segment[:-SEGMENT_TAG_SIZE]
+            key = int.from_bytes(payload[:FRAME_CHECKSUM_SIZE], 'little')
+            if len(payload) >= FRAME_HEADER_SIZE and segment[-SEGMENT_TAG_SIZE:] == self.segment_tag(0, payload, key):
+                stored[0] = payload
+        if 0 in stored:
+            key = int.from_bytes(stored[0][:FRAME_CHECKSUM_SIZE], 'little')
+            frame_size = self.frame_size(stored[0])
+        else:
+            # any parity segment tells where the rest of the frame is
+            for s in range(first_parity, self.segments):
+                if s not in stored:
+                    self.read_parity(segment_files[s], capacity, s, stored)
+                if s in stored:
+                    key, frame_size = PARITY_FIELDS.unpack_from(stored[s])
+                    break
+            else:
+                # the rest cannot be located without the header, ask for it alone
+                return None, all_segments & ~1
+        count = self.segment_count(files, frame_size)
+        sizes = [min(capacity, frame_size - s * capacity) for s in range(count)]
+        missing = [] if 0 in stored else [0]
+        for s in range(1, count):
+            if s in stored:
+                continue
+            segment = self.read_segment(segment_files[s], sizes[s])
+            payload, tag = segment[:sizes[s]], segment[sizes[s]:]
+            if tag == self.segment_tag(s, payload, key):
+                stored[s] = payload
+            else:
+                missing.append(s)
+        if missing and self.parity:
+            parity = {}
+            for s in range(first_parity, self.segments):
+                if len(parity) == len(missing):
+                    break
+                if s not in stored:
+                    self.read_parity(segment_files[s], capacity, s, stored)
+                if s in stored and PARITY_FIELDS.unpack_from(stored[s]) == (key, frame_size):
+                    parity[s - first_parity] = stored[s][PARITY_FIELDS.size:]
+            if len(parity) == len(missing):
+                data = recover([stored.get(s) for s in range(count)], parity)
+                for s in missing:
+                    stored[s] = data[s][:sizes[s]]
+                metrics.count('segments_repaired', len(missing))
+                missing = []
+        if missing:
+            return None, all_segments & ~sum(1 << s for s in missing)
+        return b''.join(stored[s] for s in range(count)), all_segments
+
+    # stores the payload of a parity segment if its tag matches
+    def read_parity(self, files: list[str], capacity: int, index: int, stored: dict[int, bytes]) -> None:
+        segment = self.read_segment(files, PARITY_FIELDS.size,
+                                    lambda header: PARITY_FIELDS.size + min(capacity, PARITY_FIELDS.unpack_from(header)[1]))
+        payload = segment[:-SEGMENT_TAG_SIZE]
+        if len(payload) > PARITY_FIELDS.size:
+            key = PARITY_FIELDS.unpack_from(payload)[0]
+            if segment[-SEGMENT_TAG_SIZE:] == self.segment_tag(index, payload, key):
+                stored[index] = payload
+
+    # reads one segment and its tag. `size` is the payload size, or a
+    # function giving it from the first `size` bytes (the header the segment
+    # starts with)
+    def read_segment(self, files: list[str], size: int, size_of=None) -> bytes:
+        current = bytearray()
+        for chunk in self.decode_files_known(files):
+            current += chunk
+            if size_of and len(current) >= size:
+                size, size_of = size_of(current), None
+            if not size_of and len(current) >= size + SEGMENT_TAG_SIZE:
+                return bytes(current[:size + SEGMENT_TAG_SIZE])
+        return bytes(current)
+
+    ### INSTRUMENTATION (see src/metrics.py)
+    def wait_for_signal(self, *signals: Signal) -> tuple[Signal, int]:
+        with metrics.timer('signal_wait'):
+            return self.filesystem.wait_for_signal(*signals)
+
+    def count_round_trip(self, start: float, batches: int, nacks: int) -> None:
+        metrics.count('batches', batches)
+        metrics.count('nacks', nacks)
+        metrics.count('round_trips')
+        metrics.observe('batch_rtt', time.perf_counter() - start)
+
+    # raw is the message size, wire is what was batched after the codec
+    def count_payload(self, raw: int, wire: int, codec: int) -> None:
+        metrics.count('raw_bytes', raw)
+        metrics.count('wire_bytes', wire)
+        self.last_payload = (raw, wire, codec)
+
+    def count_message(self, direction: str, seconds: float) -> None:
+        raw, wire, codec = self.last_payload
+        metrics.observe(f'message_{direction}', seconds)
+        metrics.event('message', direction=direction, raw_bytes=raw, wire_bytes=wire, codec=codec,
+                      seconds=seconds, bytes_per_second=raw / seconds if seconds else 0.0)
+
+    def file_groups(self) -> list[list[str]]:
+        files = self.filesystem.get_files()
+        group_size = len(files) // self.window
+        if group_size == 0:
+            raise Exception("NOT ENOUGH FILES")
+        return [
+            files[g * group_size:(g + 1) * group_size]
+            for g in range(self.window)
+        ]
+
+    ### BATCH HELPERS
+    # split up the batch into file sized chunks and write each one
+    def write_batch(self, files: list[str], batch: bytes) -> None:
+        file_chunks = self.split_chunks(batch)
+        # a short batch leaves the files past its last chunk untouched
+        self.write_chunks(files[:len(file_chunks)], file_chunks)
+
+    def split_chunks(self, batch: bytes) -> list[bytes]:
+        file_chunks = []
+        for i in range(0, len(batch), self.data_per_file()):
+            file_chunks.append(batch[i:i+self.data_per_file()])
+        return file_chunks
+
+    def write_chunks(self, files: list[str], file_chunks: list[bytes]) -> None:
+        if self.delta_writes:
+            values = self.known_file_values()
+            changed = [i for i, (file, chunk) in enumerate(zip(files, file_chunks))
+                       if values.get(file) != chunk]
+            metrics.count('writes_skipped', len(files) - len(changed))
+            files = [files[i] for i in changed]
+            file_chunks = [file_chunks[i] for i in changed]
+        metrics.count('writes', len(files))
+        if files:
+            self.encode_files(files, file_chunks)
+        self.remember_file_values(files, file_chunks)
+
+    # read files until the terminator shows up past the header, anything
+    # after it is padding of the last file (e.g. multi byte hash carriers)
+    def read_batch(self, files: list[str], header_size: int) -> bytes:
+        current_batch = bytearray()
+        for chunk in self.decode_files_known(files):
+            # only the new chunk can hold the terminator
+            start = max(header_size, len(current_batch))
+            current_batch += chunk
+            end = current_batch.find(TERMINATOR, start)
+            if end != -1:
+                return bytes(current_batch[:end + len(TERMINATOR)])
+        return bytes(current_batch)
+
+    # read files until the length from the frame header is covered
+    def read_frame(self, files: list[str]) -> bytes:
+        current_batch = bytearray()
+        size = None
+        for chunk in self.decode_files_known(files):
+            current_batch += chunk
+            if size is None and len(current_batch) >= FRAME_HEADER_SIZE:
+                size = self.frame_size(current_batch)
+            if size is not None and len(current_batch) >= size:
+                return bytes(current_batch[:size])
+        return bytes(current_batch)
+
+    ### DELTA WRITES
+    # the peer writes the same carriers, so values seen while reading are
+    # remembered too. a NACK forgets the files of the rejected batch in case
+    # one was changed behind our back, and a repartition forgets everything
+    def known_file_values(self) -> dict[str, bytes]:
+        if self.file_values_version != self.filesystem.vfs_version:
+            self.file_values = {}
+            self.file_values_version = self.filesystem.vfs_version
+        return self.file_values
+
+    def remember_file_values(self, files: list[str], chunks: list[bytes]) -> None:
+        if self.delta_writes:
+            self.known_file_values().update(zip(files, chunks))
+
+    def forget_file_values(self, files: list[str]) -> None:
+        for file in files:
+            self.file_values.pop(file, None)
+
+    def decode_files_known(self, files: list[str]) -> Iterable[bytes]:
+        for file, chunk in zip(files, self.decode_files(files)):
+            self.remember_file_values([file], [chunk])
+            yield chunk
+
+    # whole batch hooks, protocols override these when the medium supports bulk I/O
+    def encode_files(self, files: list[str], chunks: list[bytes]) -> None:
+        if self.executor:
+            # wait for every write (re-raising errors) so DONE is only set after them
+            list(self.executor.map(self.encode_file, files, chunks))
+            return
+        for file, chunk in zip(files, chunks):
+            self.encode_file(file, chunk)
+
+    # lazy so the per file path stops reading once the batch is complete
+    def decode_files(self, files: list[str]) -> Iterable[bytes]:
+        if self.executor:
+            # results come back in file order, reads left over when the
+            # caller stops early are cancelled with the iterator
+            return self.executor.map(self.decode_file, files)
+        return (self.decode_file(file) for file in files)
 
     ### THESE METHODS NEED TO BE IMPLEMENTED
     @abstractmethod
@@ -128,5 +830,3 @@ class Protocol(ABC):
     # returns amount of bytes can be encoded per file
     def data_per_file(self) -> int:
         pass
-
-    
\ No newline at end of file
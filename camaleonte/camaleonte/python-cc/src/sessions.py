@@ -0,0 +1,156 @@
+import asyncio
+from typing import Callable, Iterable
+
+from src.mediums.async_filesystem import AsyncFilesystem, SignalPoller
+from src.mediums.filesystem import Filesystem, layout_level
+from src.metrics import metrics
+from src.protocol.async_protocol import AsyncProtocol
+from src.protocol.protocol import Protocol
+
+
+# seconds a session gets to answer a command before it is reported as
+# timed out. the exchange keeps running, the channel stays busy until it ends
+REPLY_TIMEOUT = 120
+
+
+# a connected client on its own channel. a channel carries one exchange at a
+# time, so commands to the same client queue up while other clients run
+class Session:
+    def __init__(self, channel: int, cc: AsyncProtocol) -> None:
+        self.channel = channel
+        self.cc = cc
+        self.lock = asyncio.Lock()
+
+    # sends a command and returns the reply
+    async def request(self, data: bytes) -> bytes:
+        async with self.lock:
+            await self.cc.write(data)
+            return await self.cc.read()
+
+    # sends a command that gets no reply (quit/exit)
+    async def send(self, data: bytes) -> None:
+        async with self.lock:
+            await self.cc.write(data)
+
+    # runs a blocking helper taking the protocol (e.g. send_file from
+    # src/transfer.py) on a thread while holding the channel
+    async def run(self, call, *args):
+        async with self.lock:
+            return await asyncio.to_thread(call, self.cc.protocol, *args)
+
+
+# serves every client of a share from one process. `new_protocol` returns a
+# protocol on a fresh filesystem (the filesystem holds the channel position),
+# `filesystem` is only used to watch the client count. every client that
+# joins gets a session on the channel it took, see Protocol.connect(). the
+# protocols need epochs to serve several clients, so joins don't stall the
+# sessions already running
+class SessionManager:
+    def __init__(self, filesystem: Filesystem, new_protocol: Callable[[], Protocol],
+                 poller: SignalPoller = None) -> None:
+        self.poller = poller or SignalPoller()
+        self.filesystem = AsyncFilesystem(filesystem, self.poller)
+        self.new_protocol = new_protocol
+        self.sessions = {}
+        self.joined = asyncio.Event()
+
+    # accepts clients as the client count rises, forever. clients that were
+    # connected before the server started are not taken over. `on_error` gets
+    # the channel and exception of a client whose join failed
+    async def accept(self, on_join: Callable[[Session], None] = None,
+                     on_error: Callable[[int, Exception], None] = None) -> None:
+        known = await self.filesystem.get_client_count()
+        wait = self.filesystem.filesystem.poll_schedule.wait()
+        while True:
+            count = await self.filesystem.get_client_count()
+            if count > known:
+                # several clients may have joined since the last poll
+                for channel in range(known, count):
+                    asyncio.create_task(self.join(channel, on_join, on_error))
+                known = count
+                wait.reset()
+            await asyncio.sleep(wait.next_period())
+            await self.filesystem.run(wait.acquire)
+
+    # the session is only registered once its join went through, a failed
+    # join is reported and forgotten
+    async def join(self, channel: int, on_join: Callable[[Session], None] = None,
+                   on_error: Callable[[int, Exception], None] = None) -> None:
+        try:
+            session = await self.start(channel)
+        except Exception as e:
+            metrics.event('session_failed', channel=channel, error=str(e))
+            if on_error:
+                on_error(channel, e)
+            return
+        self.add(session)
+        if on_join:
+            on_join(session)
+
+    async def start(self, channel: int) -> Session:
+        cc = AsyncProtocol(await self.filesystem.run(self.new_protocol), self.poller)
+        # without epochs a join repartitions the share under the sessions
+        # already running and clears their sync files, so their transfers hang
+        if not cc.protocol.epochs and self.sessions:
+            raise ValueError("Only one client can be served without epochs, join with epochs on both ends")
+        # the files of the new channel are only free once the channels holding
+        # them switched layouts, which idle ones only do when told to
+        level = layout_level(channel + 1)
+        for other in self.sessions.values():
+            if other.cc.protocol.filesystem.layout_level < level:
+                asyncio.create_task(self.switch(other))
+        await cc.join_channel(channel)
+        return Session(channel, cc)
+
+    def add(self, session: Session) -> Session:
+        self.sessions[session.channel] = session
+        metrics.event('session_join', channel=session.channel)
+        self.joined.set()
+        return session
+
+    async def switch(self, session: Session) -> None:
+        async with session.lock:
+            await session.cc.switch_layout()
+
+    async def wait_for_session(self) -> None:
+        await self.joined.wait()
+
+    # the sessions of `channels`, all of them when None
+    def select(self, channels: Iterable[int] = None) -> list[Session]:
+        if channels is None:
+            return list(self.sessions.values())
+        return [self.sessions[c] for c in channels if c in self.sessions]
+
+    # sends the command to every selected client at once, returns channel -> reply
+    # (or the exception that session raised, TimeoutError if it did not answer in time)
+    async def request(self, data: bytes, channels: Iterable[int] = None,
+                      timeout: float = REPLY_TIMEOUT) -> dict:
+        return await self.gather(channels, lambda session: session.request(data), timeout)
+
+    # runs a blocking helper on every selected session at once, see Session.run
+    async def run(self, call, *args, channels: Iterable[int] = None,
+                  timeout: float = REPLY_TIMEOUT) -> dict:
+        return await self.gather(channels, lambda session: session.run(call, *args), timeout)
+
+    # sessions still busy after `timeout` seconds are left running, cancelling
+    # them halfway through an exchange would desync their channels
+    async def gather(self, channels: Iterable[int], action, timeout: float = REPLY_TIMEOUT) -> dict:
+        tasks = {session.channel: asyncio.ensure_future(action(session))
+                 for session in self.select(channels)}
+        if tasks:
+            await asyncio.wait(tasks.values(), timeout=timeout)
+        results = {}
+        for channel, task in tasks.items():
+            if not task.done():
+                results[channel] = TimeoutError(f"no reply within {timeout} s, the command keeps running")
+            else:
+                results[channel] = task.exception() or task.result()
+        return results
+
+    # tells the selected clients to quit and forgets them
+    async def close(self, data: bytes, channels: Iterable[int] = None,
+                    timeout: float = REPLY_TIMEOUT) -> None:
+        sessions = self.select(channels)
+        await self.gather(channels, lambda session: session.send(data), timeout)
+        for session in sessions:
+            del self.sessions[session.channel]
@@ -0,0 +1,163 @@
+import os
+import zlib
+
+from src.metrics import metrics
+from src.protocol.protocol import Protocol
+from src.utils import decode_base64, encode_base64
+
+
+# files are moved in chunks of this size so memory stays bounded
+CHUNK_SIZE = 64 * 1024
+# partial transfers are kept here until the last chunk arrives so they can be resumed
+PART_SUFFIX = '.part'
+
+# Chunk commands (the path goes last so it may contain spaces):
+#   partsize <path>                                 -> success <bytes already received> <crc32 of them>
+#   prefixcrc <size> <path>                         -> success <crc32 of the first size bytes>
+#   upload_chunk <offset> <total> <path>\n<data>    -> success <bytes received>
+#   download_chunk <offset> <size> <path>           -> success <total>\n<data>
+# <data> is sent raw over a framed (binary safe) channel and base64 otherwise
+
+
+def encode_chunk(chunk: bytes, binary: bool) -> bytes:
+    return chunk if binary else encode_base64(chunk)
+
+
+def decode_chunk(data: bytes, binary: bool) -> bytes:
+    return data if binary else decode_base64(data)
+
+
+# crc32 of the first `size` bytes of a file, read in chunks. a partial file is
+# only resumed when its bytes match the start of the file being sent, so a
+# leftover .part of another file with the same name is started over
+def prefix_crc(path: str, size: int, chunk_size: int = CHUNK_SIZE) -> int:
+    crc = 0
+    with open(path, 'rb') as fil:
+        while size > 0:
+            chunk = fil.read(min(chunk_size, size))
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size -= len(chunk)
+    return crc
+
+
+### SERVER SIDE
+def send_file(cc: Protocol, localpath: str, remotepath: str, chunk_size: int = CHUNK_SIZE) -> bool:
+    total = os.path.getsize(localpath)
+    # resume from whatever the client already acknowledged
+    cc.write(b'partsize ' + remotepath.encode())
+    reply = cc.read().split(b' ')
+    offset = int(reply[1]) if reply[0] == b'success' else 0
+    if offset > total or offset and int(reply[2]) != prefix_crc(localpath, offset):
+        offset = 0
+    with open(localpath, 'rb') as fil:
+        while True:
+            fil.seek(offset)
+            chunk = fil.read(chunk_size)
+            cc.write(b' '.join([
+                b'upload_chunk', str(offset).encode(), str(total).encode(),
+                remotepath.encode()
+            ]) + b'\n' + encode_chunk(chunk, cc.framing))
+            reply = cc.read().split(b' ')
+            if reply[0] != b'success':
+                return False
+            offset = int(reply[1])
+            # progress goes to the metrics sink, several sessions may upload at once
+            metrics.event('chunk_uploaded', offset=offset, total=total)
+            if offset >= total:
+                return True
+
+
+def receive_file(cc: Protocol, remotepath: str, localpath: str, chunk_size: int = CHUNK_SIZE) -> bool:
+    part = localpath + PART_SUFFIX
+    offset = os.path.getsize(part) if os.path.isfile(part) else 0
+    if offset:
+        cc.write(b' '.join([b'prefixcrc', str(offset).encode(), remotepath.encode()]))
+        reply = cc.read().split(b' ')
+        if reply[0] != b'success' or int(reply[1]) != prefix_crc(part, offset):
+            offset = 0
+    with open(part, 'r+b' if offset else 'wb') as fil:
+        while True:
+            cc.write(b' '.join([
+                b'download_chunk', str(offset).encode(), str(chunk_size).encode(),
+                remotepath.encode()
+            ]))
+            header, _, chunk = cc.read().partition(b'\n')
+            reply = header.split(b' ')
+            if reply[0] != b'success':
+                break
+            total = int(reply[1])
+            if offset > total:
+                # stale partial data from a larger file, start over
+                offset = 0
+                fil.truncate(0)
+                continue
+            chunk = decode_chunk(chunk, cc.framing)
+            if not chunk and offset < total:
+                break
+            fil.seek(offset)
+            fil.write(chunk)
+            fil.flush()
+            offset += len(chunk)
+            metrics.event('chunk_downloaded', offset=offset, total=total)
+            if offset == total:
+                fil.truncate()
+                fil.close()
+                os.replace(part, localpath)
+                return True
+    # keep partial data around so the next download resumes from it
+    if offset == 0:
+        os.remove(part)
+    return False
+
+
+### CLIENT SIDE
+def handle_partsize(path: bytes) -> bytes:
+    part = path.decode() + PART_SUFFIX
+    size = os.path.getsize(part) if os.path.isfile(part) else 0
+    crc = prefix_crc(part, size) if size else 0
+    return b'success ' + str(size).encode() + b' ' + str(crc).encode()
+
+
+def handle_prefixcrc(size: bytes, path: bytes) -> bytes:
+    try:
+        return b'success ' + str(prefix_crc(path.decode(), int(size))).encode()
+    except Exception:
+        return b'failed'
+
+
+def handle_upload_chunk(offset: bytes, total: bytes, path: bytes, filedata: bytes, binary: bool) -> bytes:
+    try:
+        offset, total = int(offset), int(total)
+        filename = path.decode()
+        part = filename + PART_SUFFIX
+        chunk = decode_chunk(filedata, binary)
+        if offset == 0:
+            mode = 'wb'
+        elif os.path.isfile(part) and os.path.getsize(part) >= offset:
+            mode = 'r+b'
+        else:
+            return b'failed'
+        with open(part, mode) as fil:
+            fil.seek(offset)
+            fil.write(chunk)
+            fil.truncate()
+        received = offset + len(chunk)
+        if received >= total:
+            os.replace(part, filename)
+        return b'success ' + str(received).encode()
+    except Exception as e:
+        metrics.event('chunk_upload_failed', path=path.decode(errors='replace'), error=str(e))
+        return b'failed'
+
+
+def handle_download_chunk(offset: bytes, size: bytes, path: bytes, binary: bool) -> bytes:
+    try:
+        with open(path.decode(), 'rb') as fil:
+            total = os.fstat(fil.fileno()).st_size
+            fil.seek(int(offset))
+            chunk = fil.read(int(size))
+        return b'success ' + str(total).encode() + b'\n' + encode_chunk(chunk, binary)
+    except Exception:
+        return b'failed'
@@ -1,18 +1,83 @@
-import zlib, base64
+import zlib, base64, lzma
+from functools import lru_cache
+
+from src.metrics import metrics
 
 
 TERMINATOR = b'\x04'
 
+# mined suffixes are built from these two whitespace characters
+HASH_PAD_CHAR = b' '
+HASH_FLIP_CHAR = b'\t'
+
 
 def get_hash_byte(data: bytes) -> int:
     return zlib.crc32(data) % 256
 
 
+def get_hash_bits(data: bytes, bits: int) -> int:
+    return zlib.crc32(data) & ((1 << bits) - 1)
+
+
 # TODO: make this modify differently based on filetype
 def set_hash_byte(data: bytes, desired: int) -> bytes:
-    while zlib.crc32(data) % 256 != desired:
-        data += b' '
-    return data
+    return set_hash_bits(data, desired, 8)
+
+
+# appends a short whitespace suffix so the low `bits` bits of the crc32 equal desired
+def set_hash_bits(data: bytes, desired: int, bits: int) -> bytes:
+    with metrics.timer('hash_mine'):
+        return _mine_hash_bits(data, desired, bits)
+
+
+def _mine_hash_bits(data: bytes, desired: int, bits: int) -> bytes:
+    mask = (1 << bits) - 1
+    # only hash the prefix once, the suffix is hashed from its running state
+    prefix_crc = zlib.crc32(data)
+    if prefix_crc & mask == desired:
+        return data
+    length, basis = _suffix_basis(bits)
+    suffix = bytearray(HASH_PAD_CHAR * length)
+    current = zlib.crc32(suffix, prefix_crc) & mask
+    # crc32 is linear, so solve which pad chars to flip instead of searching
+    _, flips = _reduce(basis, current ^ desired, 0)
+    for i in range(length):
+        if flips >> i & 1:
+            suffix[i] = HASH_FLIP_CHAR[0]
+    return data + bytes(suffix)
+
+
+# the crc delta of flipping a suffix char does not depend on the data before it,
+# so the basis only has to be computed once per width
+@lru_cache(maxsize=None)
+def _suffix_basis(bits: int) -> tuple[int, dict]:
+    mask = (1 << bits) - 1
+    flip = HASH_PAD_CHAR[0] ^ HASH_FLIP_CHAR[0]
+    length = bits
+    while True:
+        zeros_crc = zlib.crc32(bytes(length))
+        basis = {}
+        for i in range(length):
+            delta = bytearray(length)
+            delta[i] = flip
+            vec, combo = _reduce(basis, (zlib.crc32(delta) ^ zeros_crc) & mask, 1 << i)
+            if vec:
+                basis[vec.bit_length() - 1] = (vec, combo)
+        if len(basis) == bits:
+            return length, basis
+        length += 1
+
+
+# gaussian elimination over GF(2), tracking which suffix positions were combined
+def _reduce(basis: dict, vec: int, combo: int) -> tuple[int, int]:
+    while vec:
+        top = vec.bit_length() - 1
+        if top not in basis:
+            break
+        basis_vec, basis_combo = basis[top]
+        vec ^= basis_vec
+        combo ^= basis_combo
+    return vec, combo
 
 
 # get the bytes of the crc32 hash
@@ -32,3 +97,42 @@ def encode_base64(data: bytes) -> bytes:
 
 def decode_base64(data: bytes) -> bytes:
     return base64.b64decode(data)
+
+
+# payload codecs, stored in the framed batch header
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+# smaller payloads do not gain enough to pay for the codec overhead
+COMPRESS_MIN_SIZE = 64
+# lzma compresses better but is only worth its cpu on larger payloads
+LZMA_MIN_SIZE = 64 * 1024
+# a cheap zlib pass over this much data decides if the payload is compressible
+COMPRESS_SAMPLE_SIZE = 4096
+COMPRESS_SAMPLE_RATIO = .95
+
+
+# returns (codec, data), falling back to CODEC_RAW when compression does not help
+def compress_payload(data: bytes) -> tuple[int, bytes]:
+    if len(data) < COMPRESS_MIN_SIZE:
+        return CODEC_RAW, data
+    # skip already compressed / encrypted data without compressing all of it
+    if len(data) > COMPRESS_SAMPLE_SIZE:
+        sample = data[:COMPRESS_SAMPLE_SIZE]
+        if len(zlib.compress(sample, 1)) > len(sample) * COMPRESS_SAMPLE_RATIO:
+            return CODEC_RAW, data
+    if len(data) >= LZMA_MIN_SIZE:
+        codec, packed = CODEC_LZMA, lzma.compress(data, preset=6)
+    else:
+        codec, packed = CODEC_ZLIB, zlib.compress(data, 9)
+    if len(packed) >= len(data):
+        return CODEC_RAW, data
+    return codec, packed
+
+
+def decompress_payload(codec: int, data: bytes) -> bytes:
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_LZMA:
+        return lzma.decompress(data)
+    return data